@@ -3,40 +3,1163 @@ Plugin for managing a Kraken account.
 This module can be imported by trade_manager and used like a plugin.
 """
 import base64
+import binascii
+import bisect
 import datetime
+import fcntl
+import functools
 import hashlib
 import hmac
 import json
+import math
+import os
+import struct
+import threading
 import time
 import urllib
+from decimal import Decimal, ROUND_DOWN, ROUND_UP
+from array import array
+from multiprocessing.pool import ThreadPool
 from ledger import Amount, Balance
 import requests
 from requests import Timeout
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout
 from requests.packages.urllib3.connection import ConnectionError
 
 from sqlalchemy_models import jsonify2
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import websocket
+except ImportError:
+    websocket = None
+try:
+    import ujson as fastjson
+except ImportError:
+    try:
+        import simplejson as fastjson
+    except ImportError:
+        fastjson = None
 from trade_manager import em, wm
 from trade_manager.plugin import ExchangePluginBase, get_order_by_order_id, submit_order
 
 baseUrl = 'https://api.kraken.com'
+wsUrl = 'wss://ws.kraken.com'
 REQ_TIMEOUT = 10  # seconds
+POOL_SIZE = 10  # keep-alive connections per host
+# history endpoints return large pages and are slow to answer under load
+ENDPOINT_TIMEOUTS = {
+    'TradesHistory': 30,
+    'Ledgers': 30,
+    'ClosedOrders': 30,
+}
+
+# (maximum API counter, counter decay per second) for each Kraken verification tier
+API_TIERS = {
+    'starter': (15, 0.33),
+    'intermediate': (20, 0.5),
+    'pro': (20, 1.0),
+}
+# API counter cost of private methods; anything not listed costs 1.
+# Order placement and cancellation are limited by the matching engine, not the API counter.
+METHOD_COSTS = {
+    'TradesHistory': 2,
+    'QueryTrades': 2,
+    'Ledgers': 2,
+    'QueryLedgers': 2,
+    'AddOrder': 0,
+    'AddOrderBatch': 0,
+    'CancelOrder': 0,
+    'CancelOrderBatch': 0,
+    'CancelAll': 0,
+}
+# methods which must leave RATE_RESERVE of the counter free for order management
+HISTORY_METHODS = ['TradesHistory', 'QueryTrades', 'Ledgers', 'QueryLedgers', 'ClosedOrders']
+RATE_RESERVE = 3
+# private methods taking nested parameters, which are sent as a JSON body
+JSON_METHODS = ['AddOrderBatch', 'CancelOrderBatch']
+ORDER_METHODS = ['AddOrder', 'AddOrderBatch']  # never resent once sent, as Kraken may have placed the orders
+ORDER_BATCH_SIZE = 15  # the most orders Kraken accepts in one AddOrderBatch
+CANCEL_BATCH_SIZE = 50  # the most orders Kraken accepts in one CancelOrderBatch
+BACKFILL_WORKERS = 4  # history pages fetched at once during a backfill
+LEDGER_SYNC_REUSE = 60  # seconds a completed ledgers pass also answers the other of sync_credits and sync_debits
+ASYNC_WORKERS = 8  # requests KrakenAsync keeps in flight at once
+BACKFILL_WINDOW = 60 * 60 * 24 * 30  # seconds of history per backfill window
+KRAKEN_EPOCH = 1378000000  # no account history predates September 2013
+
+OPEN_ORDERS_TTL = 2  # seconds an open orders snapshot is reused
+WRITE_BATCH_OPS = 20  # operations gathered before the write-behind commits
+WRITE_BATCH_DELAY = 0.5  # seconds the oldest gathered operation may wait for its commit
+KNOWN_IDS_MAX = 500000  # stored ids kept exactly per history stream; beyond it only the Bloom filter remembers
+BLOOM_ERROR_RATE = 0.001
+TICKER_INTERVAL = 5  # seconds between ticker syncs in run_tickers
+BOOK_DEPTH = 10  # price levels kept per side; Kraken checksums the top 10
+
+METADATA_FILE = '~/.tapp/kraken/metadata.json'
+METADATA_TTL = 60 * 60  # seconds before cached asset pairs, assets and fees are refreshed
+METADATA_RETRY = 60  # seconds before a failed metadata refresh is tried again
+
+NONCE_FILE = '~/.tapp/kraken/nonce'
+# atomically hand out max(now, last + 1) so nonces only ever increase, even across processes
+NONCE_SCRIPT = """
+local last = tonumber(redis.call('GET', KEYS[1]) or '0')
+local nonce = tonumber(ARGV[1])
+if nonce <= last then
+    nonce = last + 1
+end
+redis.call('SET', KEYS[1], string.format('%d', nonce))
+return string.format('%d', nonce)
+"""
 
 FIAT_CURRENCIES = ['USD', 'EUR', 'GBP']
+# per user high-water mark of each history stream
+CURSOR_KEY = 'kraken_%s_%s_cursor'
+# per user set of completed backfill windows of each history stream
+BACKFILL_KEY = 'kraken_%s_%s_backfill'
+# number of commits which inserted kraken rows of each model, by any process
+KNOWN_IDS_KEY = 'kraken_%s_commits'
+
+
+def decode_response(raw):
+    """
+    Decode a Kraken response body straight from its bytes, with ujson or simplejson if installed.
+
+    :raise ValueError: if raw is not valid JSON
+    """
+    if fastjson is not None:
+        return fastjson.loads(raw)
+    return json.loads(raw)
+
+
+def has_error(resp, code):
+    """
+    :return: True if one of the errors in the error list of a decoded response contains code
+    """
+    if not isinstance(resp, dict):
+        return False
+    for error in resp.get('error') or []:
+        if code in error:
+            return True
+    return False
+
+
+def newest_cursor(rows, cursor=None, time_field='time'):
+    """
+    :return: the time and id of the newest of a page of history rows, or cursor if it is newer
+    """
+    for rid, row in rows.iteritems():
+        rtime = float(row[time_field])
+        if cursor is None or rtime > cursor['time']:
+            cursor = {'time': rtime, 'id': rid}
+    return cursor
+
+
+def newest_record(records, cursor=None):
+    """
+    :return: the time and id of the newest of a page of decoded history records, or cursor if it is newer
+    """
+    for rec in records:
+        rtime = float(rec.time)
+        if cursor is None or rtime > cursor['time']:
+            cursor = {'time': rtime, 'id': rec.id}
+    return cursor
+
+
+def page_rows(resp, key, offset):
+    """
+    :return: the rows of one page of a Kraken history response
+    :raise IOError: if the response holds no result
+    """
+    if not resp or 'result' not in resp:
+        raise IOError("unable to fetch kraken %s at offset %s: %s" % (key, offset, resp))
+    return resp['result'][key]
+
+
+def decimal_amount(value, commodity):
+    """
+    :return: an Amount of a Decimal value in commodity, written out in full so small values never use an exponent
+    """
+    return Amount("%s %s" % (format(value, 'f'), commodity))
+
+
+def fixed_decimals(value, decimals):
+    """
+    :return: the decimal string value written out with exactly decimals places
+    """
+    return format(Decimal(value).quantize(Decimal(1).scaleb(-decimals)), 'f')
+
+
+def count_decimals(value):
+    """
+    :return: the number of places after the decimal point of the decimal string value
+    """
+    return len(value) - value.index('.') - 1 if '.' in value else 0
+
+
+class TradeRecord(object):
+    """A decoded TradesHistory row."""
+    __slots__ = ('id', 'market', 'side', 'price', 'vol', 'fee', 'time')
+
+    def __init__(self, id, market, side, price, vol, fee, time):
+        self.id = id
+        self.market = market
+        self.side = side
+        self.price = price
+        self.vol = vol
+        self.fee = fee
+        self.time = time
+
+    @classmethod
+    def decode(cls, id, row, markets):
+        """
+        :param markets: a function from a Kraken pair to its (market, base, quote)
+        """
+        return cls(id, markets(row['pair'])[0], row['type'], Decimal(row['price']), Decimal(row['vol']),
+                   Decimal(row['fee']), Decimal(row['time']))
+
+
+class LedgerRecord(object):
+    """A decoded Ledgers row."""
+    __slots__ = ('id', 'refid', 'type', 'asset', 'amount', 'fee', 'time')
+
+    def __init__(self, id, refid, type, asset, amount, fee, time):
+        self.id = id
+        self.refid = refid
+        self.type = type
+        self.asset = asset
+        self.amount = amount
+        self.fee = fee
+        self.time = time
+
+    @classmethod
+    def decode(cls, id, row, commodities):
+        """
+        :param commodities: a function from a Kraken asset to its commodity
+        """
+        return cls(id, row['refid'], row['type'], commodities(row['asset']), Decimal(row['amount']),
+                   Decimal(row['fee']), Decimal(row['time']))
+
+
+class OrderRecord(object):
+    """
+    A decoded OpenOrders or ClosedOrders row. price is the order's limit price and
+    avg_price the average price it executed at.
+    """
+    __slots__ = ('id', 'market', 'base', 'quote', 'side', 'price', 'avg_price', 'vol', 'vol_exec')
+
+    def __init__(self, id, market, base, quote, side, price, avg_price, vol, vol_exec):
+        self.id = id
+        self.market = market
+        self.base = base
+        self.quote = quote
+        self.side = side
+        self.price = price
+        self.avg_price = avg_price
+        self.vol = vol
+        self.vol_exec = vol_exec
+
+    @classmethod
+    def decode(cls, id, row, markets):
+        """
+        :param markets: a function from a Kraken pair to its (market, base, quote)
+        """
+        descr = row['descr']
+        market, base, quote = markets(descr['pair'])
+        return cls(id, market, base, quote, 'ask' if descr['type'] == 'sell' else 'bid',
+                   Decimal(descr.get('price') or 0), Decimal(row.get('price') or 0), Decimal(row['vol']),
+                   Decimal(row['vol_exec']))
+
+    def remaining(self):
+        return self.vol - self.vol_exec
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over strings, sized for capacity keys at error_rate false positives,
+    using double hashing of one MD5 digest.
+    """
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        self.capacity = max(int(capacity), 1)
+        self.size = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(int(round(self.size / float(self.capacity) * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self.positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count > self.capacity
+
+
+class KnownIds(object):
+    """
+    Per-process index of the stored ids of one history stream. A Bloom filter in front
+    answers most misses, up to max_ids are also kept exactly, and only Bloom filter hits
+    beyond those need the database. Once other processes have stored ids the index has
+    not seen it is behind, and its misses need the database too.
+    """
+
+    def __init__(self, capacity, max_ids=KNOWN_IDS_MAX, error_rate=BLOOM_ERROR_RATE, version=0):
+        self.bloom = BloomFilter(max(capacity * 2, 1024), error_rate)
+        self.max_ids = max_ids
+        self.ids = set()
+        self.complete = True
+        self.version = version  # the model's commit count the index is up to date with
+        self.behind = False
+
+    def add(self, ref):
+        self.bloom.add(ref)
+        if len(self.ids) < self.max_ids:
+            self.ids.add(ref)
+        else:
+            self.complete = False
+
+    def split(self, refs):
+        """
+        :return: the set of refs known to be stored, and a list of the refs which only the database can settle
+        """
+        known = set()
+        maybe = []
+        for ref in refs:
+            if ref not in self.bloom:
+                if self.behind:
+                    maybe.append(ref)
+                continue
+            if ref in self.ids:
+                known.add(ref)
+            elif not self.complete or self.behind:
+                maybe.append(ref)
+        return known, maybe
+
+
+class SymbolTable(object):
+    """
+    Bidirectional lookups between Kraken's asset and pair names and the standard
+    commodity and market symbols, built once from the Assets and AssetPairs endpoints.
+    """
+
+    def __init__(self, assets, pairs):
+        self.commodities = {}  # kraken asset name or altname -> commodity
+        self.assets = {}  # commodity -> kraken asset name
+        self.markets = {}  # kraken pair name, altname or wsname -> market
+        self.pairs = {}  # market -> kraken pair name
+        self.wsnames = {}  # market -> kraken websocket pair name
+        for name, asset in assets.iteritems():
+            commodity = 'BTC' if asset['altname'] == 'XBT' else asset['altname']
+            self.commodities[name] = commodity
+            self.commodities[asset['altname']] = commodity
+            self.commodities[commodity] = commodity
+            self.assets.setdefault(commodity, name)
+        for name, pair in pairs.iteritems():
+            if name.endswith('.d'):
+                continue  # dark pool books share the symbols of the regular pair
+            market = "%s_%s" % (self.commodities.get(pair['base'], pair['base']),
+                                self.commodities.get(pair['quote'], pair['quote']))
+            for alias in (name, pair.get('altname'), pair.get('wsname'), market):
+                if alias:
+                    self.markets[alias] = market
+            self.pairs[market] = name
+            if pair.get('wsname'):
+                self.wsnames[market] = pair['wsname']
+
+
+class ExchangeMetadata(object):
+    """
+    Kraken's asset pairs, assets and the account's fee tier, cached on disk with a TTL.
+    Used to round and validate orders before they are sent.
+    """
+
+    def __init__(self, assets, pairs, fees=None, fetched=None):
+        self.assets = assets
+        self.pairs = pairs
+        self.fees = fees or {}
+        self.fetched = fetched if fetched is not None else time.time()
+        self.symbols = SymbolTable(assets, pairs)
+
+    def is_stale(self, ttl=METADATA_TTL):
+        return time.time() - self.fetched > ttl
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: the metadata cached at path, or None if there is no readable cache
+        """
+        try:
+            with open(os.path.expanduser(path)) as f:
+                raw = json.load(f)
+            return cls(raw['assets'], raw['pairs'], raw.get('fees'), raw['fetched'])
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def save(self, path):
+        path = os.path.expanduser(path)
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'assets': self.assets, 'pairs': self.pairs, 'fees': self.fees,
+                       'fetched': self.fetched}, f)
+        os.rename(path + '.tmp', path)
+
+    def round_order(self, pair, side, price, volume):
+        """
+        Round an order to the precision of its pair. Prices are rounded away from the
+        other side of the book and volumes down, so an order is never more aggressive
+        or larger than requested.
+
+        :return: the rounded price and volume strings
+        :raise ValueError: if the rounded order is below the pair's minimum
+        """
+        info = self.pairs.get(pair)
+        if info is None:
+            return price, volume
+        dprice = Decimal(price).quantize(Decimal(1).scaleb(-int(info['pair_decimals'])),
+                                         rounding=ROUND_DOWN if side == 'buy' else ROUND_UP)
+        dvolume = Decimal(volume).quantize(Decimal(1).scaleb(-int(info['lot_decimals'])), rounding=ROUND_DOWN)
+        if dvolume <= 0 or 'ordermin' in info and dvolume < Decimal(info['ordermin']):
+            raise ValueError("volume %s is below the %s minimum of %s" % (volume, pair, info.get('ordermin')))
+        if 'costmin' in info and dprice * dvolume < Decimal(info['costmin']):
+            raise ValueError("cost %s is below the %s minimum of %s" % (dprice * dvolume, pair, info['costmin']))
+        return str(dprice), str(dvolume)
+
+    def book_decimals(self, pair):
+        """
+        :return: the decimals of pair's prices and volumes, or None if pair is unknown
+        """
+        info = self.pairs.get(pair)
+        if info is None:
+            return None
+        return int(info['pair_decimals']), int(info['lot_decimals'])
+
+
+class WriteBehind(object):
+    """
+    Unit of work which gathers ORM changes from several plugin operations and commits
+    them in one transaction, after max_ops operations or once the oldest has waited
+    max_delay seconds. Keeps per-batch commit latency and size metrics.
+
+    Plugin methods using the session hold lock (see the uses_session decorator), and
+    commit a batch which has waited max_delay as they start and finish, on the thread
+    which owns the session. The session is not thread safe and a commit expires the ORM
+    instances its users hold, so no other thread ever commits it; a batch gathered just
+    before the plugin goes quiet waits for its next operation.
+    """
+
+    def __init__(self, session, logger, max_ops=WRITE_BATCH_OPS, max_delay=WRITE_BATCH_DELAY):
+        self.session = session
+        self.logger = logger
+        self.max_ops = max_ops
+        self.max_delay = max_delay
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.oldest = None
+        self.batches = 0
+        self.committed = 0
+        self.last_size = 0
+        self.last_latency = 0.0
+        self.total_latency = 0.0
+        self.depth = 0  # nested uses_session calls in progress
+
+    def commit(self, now=False):
+        """
+        Count one operation's changes, committing the batch if it is full, old enough, or now is True.
+
+        :return: False if a commit was attempted and failed, otherwise True
+        """
+        with self.lock:
+            self.pending += 1
+            if self.oldest is None:
+                self.oldest = time.time()
+            if now or self.pending >= self.max_ops or time.time() - self.oldest >= self.max_delay:
+                return self.flush()
+            return True
+
+    def flush(self):
+        """
+        Commit every gathered change now.
+
+        :return: False if the commit failed and was rolled back, otherwise True
+        """
+        with self.lock:
+            if self.pending == 0:
+                return True
+            size = self.pending
+            self.pending = 0
+            self.oldest = None
+            started = time.time()
+            try:
+                self.session.commit()
+                ok = True
+            except Exception as e:
+                self.logger.exception(e)
+                self.session.rollback()
+                self.session.flush()
+                ok = False
+            self.last_latency = time.time() - started
+            self.last_size = size
+            self.total_latency += self.last_latency
+            self.batches += 1
+            self.committed += size
+            self.logger.debug("committed %s kraken operations in %.4fs" % (size, self.last_latency))
+            return ok
+
+    def stats(self):
+        return {'batches': self.batches,
+                'operations': self.committed,
+                'pending': self.pending,
+                'last_size': self.last_size,
+                'last_latency': self.last_latency,
+                'mean_latency': self.total_latency / self.batches if self.batches > 0 else 0.0,
+                'mean_size': float(self.committed) / self.batches if self.batches > 0 else 0.0}
+
+    def rollback(self):
+        """Discard every gathered change, so the pending count matches the session again."""
+        with self.lock:
+            self.session.rollback()
+            self.session.flush()
+            self.pending = 0
+            self.oldest = None
+
+    def flush_overdue(self):
+        """
+        Commit the gathered changes if the oldest has waited max_delay.
+
+        :return: False if a commit was attempted and failed, otherwise True
+        """
+        with self.lock:
+            if self.oldest is not None and time.time() - self.oldest >= self.max_delay:
+                return self.flush()
+            return True
+
+
+def uses_session(method):
+    """
+    Run a plugin method holding the write-behind lock, so pending writes are never committed
+    mid-operation, and commit an overdue batch before and after the outermost such method.
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        writes = self.get_writes()
+        with writes.lock:
+            if writes.depth == 0:
+                writes.flush_overdue()
+            writes.depth += 1
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                writes.depth -= 1
+            if writes.depth == 0:
+                writes.flush_overdue()
+            return result
+    return locked
+
+
+class KrakenTransport(object):
+    """
+    Pooled, keep-alive HTTP transport for the Kraken REST API.
+
+    A single requests.Session is shared by all calls so TCP connections and TLS
+    sessions are reused instead of being set up again for every request.
+    """
+
+    def __init__(self, base_url=baseUrl, pool_size=POOL_SIZE, timeout=REQ_TIMEOUT, timeouts=None):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.timeouts = dict(ENDPOINT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def get_timeout(self, method):
+        return self.timeouts.get(method, self.timeout)
+
+    def post(self, path, method, data=None, headers=None):
+        with self._lock:
+            self.requests += 1
+        return self.session.post(self.base_url + path, data=data, headers=headers,
+                                 timeout=self.get_timeout(method))
+
+    def get(self, path, method, query=None):
+        with self._lock:
+            self.requests += 1
+        url = self.base_url + path
+        if query:
+            url += "?" + query
+        return self.session.get(url, timeout=self.get_timeout(method))
+
+    def stats(self):
+        """
+        :return: a dict with the number of requests sent, connections opened and connections reused.
+        """
+        pools = self.adapter.poolmanager.pools
+        connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+        return {'requests': self.requests,
+                'connections': connections,
+                'reused': max(self.requests - connections, 0),
+                'pool_size': self.pool_size}
+
+    def close(self):
+        self.session.close()
+
+
+class RateLimiter(object):
+    """
+    Token bucket model of Kraken's private API call counter.
+
+    Every private request is charged its cost before it is sent, and blocks until the
+    counter has decayed far enough for the request to be accepted. History requests
+    keep a reserve free so a backfill can not starve order management.
+    """
+
+    def __init__(self, tier='starter', reserve=RATE_RESERVE):
+        self.max_counter, self.decay = API_TIERS[tier]
+        self.reserve = reserve
+        self.counter = 0.0
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def _decay(self):
+        now = time.time()
+        self.counter = max(0.0, self.counter - (now - self.stamp) * self.decay)
+        self.stamp = now
+
+    @staticmethod
+    def cost(method):
+        return METHOD_COSTS.get(method, 1)
+
+    def remaining(self):
+        """
+        :return: the number of counter units that can be spent right now.
+        """
+        with self._lock:
+            self._decay()
+            return self.max_counter - self.counter
+
+    def acquire(self, method):
+        """
+        Charge the cost of method to the counter, sleeping until there is room for it.
+
+        :return: the number of seconds spent waiting.
+        """
+        cost = self.cost(method)
+        if cost == 0:
+            return 0
+        limit = self.max_counter - (self.reserve if method in HISTORY_METHODS else 0)
+        waited = 0
+        while True:
+            with self._lock:
+                self._decay()
+                if self.counter + cost <= limit:
+                    self.counter += cost
+                    return waited
+                wait = (self.counter + cost - limit) / self.decay
+            time.sleep(wait)
+            waited += wait
+
+    def penalize(self):
+        """Kraken rejected a request for exceeding the limit, so treat the counter as full."""
+        with self._lock:
+            self._decay()
+            self.counter = float(self.max_counter)
+
+
+class NonceGenerator(object):
+    """
+    Strictly increasing nonce source shared by every thread and process using an API key.
+
+    Nonces are millisecond timestamps, bumped past the last nonce handed out whenever
+    the clock has not moved forward (or has stepped back). The last nonce is kept in
+    Redis, or in a locked file when no Redis client is given, so it survives restarts.
+
+    A generator never mixes the two: other processes sharing the key through Redis
+    can not see the file, so if Redis fails the nonce is refused rather than drawn
+    from the file.
+    """
+
+    def __init__(self, red=None, key='kraken_nonce', path=NONCE_FILE, logger=None):
+        self.red = red
+        self.key = key
+        self.path = os.path.expanduser(path)
+        self.logger = logger
+        self.last = 0
+        self._script = None
+        self._lock = threading.Lock()
+
+    def next(self):
+        """
+        :return: the next nonce for the key
+        :raise IOError: if the Redis backend could not be reached
+        """
+        with self._lock:
+            now = max(int(time.time() * 1000), self.last + 1)
+            if self.red is None:
+                nonce = self._next_from_file(now)
+            else:
+                try:
+                    nonce = self._next_from_redis(now)
+                except Exception as e:
+                    if self.logger is not None:
+                        self.logger.exception(e)
+                    raise IOError("unable to draw a kraken nonce from redis key %s: %s" % (self.key, e))
+            self.last = nonce
+            return nonce
+
+    def _next_from_redis(self, now):
+        if self._script is None:
+            self._script = self.red.register_script(NONCE_SCRIPT)
+        return int(self._script(keys=[self.key], args=[now]))
+
+    def _next_from_file(self, now):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read().strip()
+                nonce = max(now, int(raw) + 1) if raw else now
+                f.seek(0)
+                f.truncate()
+                f.write(str(nonce))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return nonce
+
+
+class BookSide(object):
+    """
+    One side of an L2 order book: price levels in ascending price order, kept in parallel
+    arrays of floats for fast bisection, with the exchange's strings kept for checksums.
+    """
+
+    def __init__(self, descending=False, depth=BOOK_DEPTH):
+        self.descending = descending
+        self.depth = depth
+        self.prices = array('d')
+        self.volumes = array('d')
+        self.raw = []
+
+    def __len__(self):
+        return len(self.prices)
+
+    def clear(self):
+        del self.prices[:]
+        del self.volumes[:]
+        del self.raw[:]
+
+    def update(self, price, volume):
+        """Set the volume of the level at price, removing it when the volume is 0."""
+        fprice = float(price)
+        fvolume = float(volume)
+        i = bisect.bisect_left(self.prices, fprice)
+        if i < len(self.prices) and self.prices[i] == fprice:
+            if fvolume == 0:
+                del self.prices[i]
+                del self.volumes[i]
+                del self.raw[i]
+            else:
+                self.volumes[i] = fvolume
+                self.raw[i] = (price, volume)
+        elif fvolume != 0:
+            self.prices.insert(i, fprice)
+            self.volumes.insert(i, fvolume)
+            self.raw.insert(i, (price, volume))
+        if len(self.prices) > self.depth:
+            # drop the level furthest from the top of the book
+            i = 0 if self.descending else -1
+            del self.prices[i]
+            del self.volumes[i]
+            del self.raw[i]
+
+    def levels(self, count=None):
+        """
+        :return: up to count (price, volume) string pairs, best price first
+        """
+        count = len(self.raw) if count is None else count
+        if self.descending:
+            return self.raw[:-count - 1:-1] if count > 0 else []
+        return self.raw[:count]
+
+
+class OrderBook(object):
+    """
+    In-memory L2 order book of one market, maintained from Kraken's streaming book feed.
+    """
+
+    def __init__(self, market, depth=BOOK_DEPTH):
+        self.market = market
+        self.bids = BookSide(descending=True, depth=depth)
+        self.asks = BookSide(depth=depth)
+        self.timestamp = None
+        self.price_decimals = None
+        self.volume_decimals = None
+
+    def load_snapshot(self, asks, bids):
+        self.asks.clear()
+        self.bids.clear()
+        self.apply_levels(asks, bids)
+
+    def apply_levels(self, asks=(), bids=()):
+        for level in asks:
+            self.asks.update(level[0], level[1])
+            self.timestamp = level[2]
+        for level in bids:
+            self.bids.update(level[0], level[1])
+            self.timestamp = level[2]
+
+    def note_decimals(self, levels):
+        """Remember how many decimals the websocket feed writes prices and volumes with, from its first level."""
+        for level in levels[:1]:
+            self.price_decimals = count_decimals(level[0])
+            self.volume_decimals = count_decimals(level[1])
+
+    def format_levels(self, levels):
+        """
+        Write the prices and volumes of levels from the REST Depth endpoint with the websocket
+        feed's decimals, as the checksum is computed over the feed's strings ("0.43800000",
+        where Depth sends "0.438").
+
+        :return: the reformatted levels, or levels unchanged if the decimals are not known
+        """
+        if self.price_decimals is None:
+            return levels
+        return [[fixed_decimals(level[0], self.price_decimals), fixed_decimals(level[1], self.volume_decimals)] +
+                list(level[2:]) for level in levels]
+
+    def checksum(self):
+        """
+        :return: Kraken's CRC32 book checksum of the top 10 asks and bids
+        """
+        parts = []
+        for price, volume in self.asks.levels(10) + self.bids.levels(10):
+            parts.append(price.replace('.', '').lstrip('0'))
+            parts.append(volume.replace('.', '').lstrip('0'))
+        return binascii.crc32(''.join(parts).encode('ascii')) & 0xffffffff
+
+    def to_dict(self):
+        return {'market': self.market,
+                'asks': [list(level) for level in self.asks.levels()],
+                'bids': [list(level) for level in self.bids.levels()],
+                'timestamp': self.timestamp}
+
+
+class DepthBook(object):
+    """
+    Order book snapshot parsed once into NumPy price and volume arrays, best price first,
+    for vectorized pre-trade analytics. Requires numpy.
+
+    Order sides follow the rest of the plugin: a 'bid' fills against the asks and an
+    'ask' fills against the bids.
+    """
+
+    def __init__(self, market, asks, bids):
+        if np is None:
+            raise ImportError("DepthBook requires numpy")
+        self.market = market
+        asks = np.array([level[:2] for level in asks], dtype=float).reshape(-1, 2)
+        bids = np.array([level[:2] for level in bids], dtype=float).reshape(-1, 2)
+        self.ask_prices = asks[:, 0]
+        self.ask_volumes = asks[:, 1]
+        self.bid_prices = bids[:, 0]
+        self.bid_volumes = bids[:, 1]
+        # cumulative volume and quote cost, with a leading 0 for an empty fill
+        self._ask_volume = np.concatenate(([0.0], np.cumsum(self.ask_volumes)))
+        self._ask_cost = np.concatenate(([0.0], np.cumsum(self.ask_prices * self.ask_volumes)))
+        self._bid_volume = np.concatenate(([0.0], np.cumsum(self.bid_volumes)))
+        self._bid_cost = np.concatenate(([0.0], np.cumsum(self.bid_prices * self.bid_volumes)))
+
+    @classmethod
+    def from_order_book(cls, book):
+        return cls(book.market, book.asks.levels(), book.bids.levels())
+
+    def _levels(self, side):
+        if side == 'bid':
+            return self.ask_prices, self._ask_volume, self._ask_cost
+        return self.bid_prices, self._bid_volume, self._bid_cost
+
+    def best_ask(self):
+        return self.ask_prices[0] if len(self.ask_prices) > 0 else float('nan')
+
+    def best_bid(self):
+        return self.bid_prices[0] if len(self.bid_prices) > 0 else float('nan')
+
+    def mid(self):
+        return (self.best_ask() + self.best_bid()) / 2
+
+    def spread(self):
+        return self.best_ask() - self.best_bid()
+
+    def spread_bps(self):
+        return self.spread() / self.mid() * 10000
+
+    def depth_curve(self, side='bid'):
+        """
+        :return: the prices an order of side fills at and the cumulative volume available up to each
+        """
+        prices, volume, cost = self._levels(side)
+        return prices, volume[1:]
+
+    def depth_within(self, bps):
+        """
+        :param bps: one or more distances from the mid price, in basis points
+        :return: arrays of the bid volume and the ask volume within each distance
+        """
+        bps = np.atleast_1d(np.asarray(bps, dtype=float))
+        mid = self.mid()
+        nasks = np.searchsorted(self.ask_prices, mid * (1 + bps / 10000), side='right')
+        nbids = np.searchsorted(-self.bid_prices, -mid * (1 - bps / 10000), side='right')
+        return self._bid_volume[nbids], self._ask_volume[nasks]
+
+    def cost_to_fill(self, sizes, side='bid'):
+        """
+        :param sizes: one or more order sizes in the base commodity
+        :return: an array of the quote cost of filling each size, nan where the book is too thin
+        """
+        sizes = np.atleast_1d(np.asarray(sizes, dtype=float))
+        prices, volume, cost = self._levels(side)
+        costs = np.full(sizes.shape, np.nan)
+        # index of the cumulative volume which first covers each size, i.e. one past its last level
+        i = np.maximum(np.searchsorted(volume, sizes), 1)
+        filled = i < len(volume)
+        i = i[filled]
+        costs[filled] = cost[i - 1] + (sizes[filled] - volume[i - 1]) * prices[i - 1]
+        return costs
+
+    def vwap(self, sizes, side='bid'):
+        """
+        :return: an array of the average fill price of each size
+        """
+        sizes = np.atleast_1d(np.asarray(sizes, dtype=float))
+        return self.cost_to_fill(sizes, side) / sizes
+
+    def slippage_bps(self, sizes, side='bid'):
+        """
+        :return: an array of how much worse than the best price each size fills on average, in basis points
+        """
+        prices, volume, cost = self._levels(side)
+        if len(prices) == 0:
+            return np.full(np.shape(np.atleast_1d(sizes)), np.nan)
+        slip = self.vwap(sizes, side) / prices[0] - 1
+        return (slip if side == 'bid' else -slip) * 10000
 
 
 class Kraken(ExchangePluginBase):
     NAME = 'kraken'
     _user = None
+    _transport = None
+    _rate_limiter = None
+    _nonces = None
+    _books = None
+    _symbols = None
+    _metadata = None
+    _metadata_refresh = None
+    _open_orders = None  # (time fetched, raw open orders by txid)
+    _markets = {}  # Kraken pair -> (market, base, quote), cleared with the symbol table
+    _commodities = {}  # Kraken asset -> commodity, cleared with the symbol table
+    _writes = None
+    _ledgers_synced = None  # (time, rescan, stored rows by model name) of the last completed ledgers pass
+    _known_ids = {}  # model name -> KnownIds of its stored kraken ids
+
+    def get_config(self, option, default=None, cast=None):
+        """
+        Read an option from the kraken section of the plugin configuration.
+
+        :return: the configured value, or default if it is missing or unreadable.
+        """
+        try:
+            value = self.cfg.get(self.NAME, option)
+        except Exception:
+            return default
+        return cast(value) if cast is not None else value
+
+    def setup_connections(self):
+        super(Kraken, self).setup_connections()
+        self.setup_transport()
+        self.setup_rate_limiter()
+        self.setup_nonces()
+        self.load_metadata()
+        self.start_metadata_refresh()
+
+    def get_writes(self):
+        """
+        :return: the write-behind unit of work of the plugin's session
+        """
+        if self._writes is None or self._writes.session is not self.session:
+            if self._writes is not None:
+                self._writes.flush()
+            self._writes = WriteBehind(self.session, self.logger,
+                                       max_ops=self.get_config('write_batch_ops', WRITE_BATCH_OPS, int),
+                                       max_delay=self.get_config('write_batch_delay', WRITE_BATCH_DELAY, float))
+        return self._writes
+
+    def setup_transport(self):
+        """Build the shared HTTP transport from the configured pool size and timeouts."""
+        timeouts = {}
+        for method in ENDPOINT_TIMEOUTS:
+            timeouts[method] = self.get_config('timeout_%s' % method, ENDPOINT_TIMEOUTS[method], float)
+        if Kraken._transport is not None:
+            Kraken._transport.close()
+        Kraken._transport = KrakenTransport(base_url=self.get_config('base_url', baseUrl),
+                                            pool_size=self.get_config('pool_size', POOL_SIZE, int),
+                                            timeout=self.get_config('timeout', REQ_TIMEOUT, float),
+                                            timeouts=timeouts)
+        return Kraken._transport
+
+    def setup_rate_limiter(self):
+        """Build the API counter model for the configured verification tier."""
+        self._rate_limiter = RateLimiter(tier=self.get_config('tier', 'starter'),
+                                         reserve=self.get_config('rate_reserve', RATE_RESERVE, int))
+        return self._rate_limiter
+
+    def get_rate_limiter(self):
+        if self._rate_limiter is None:
+            self.setup_rate_limiter()
+        return self._rate_limiter
+
+    def setup_nonces(self):
+        """Build the nonce source, shared through Redis unless the file backend is configured."""
+        red = self.red if self.get_config('nonce_backend', 'redis') == 'redis' else None
+        key = 'kraken_%s_nonce' % hashlib.sha1(str(self.key)).hexdigest()[:16]
+        self._nonces = NonceGenerator(red=red, key=key, path=self.get_config('nonce_file', NONCE_FILE),
+                                      logger=self.logger)
+        return self._nonces
+
+    def get_nonce(self):
+        if self._nonces is None:
+            self.setup_nonces()
+        return self._nonces.next()
+
+    @classmethod
+    def get_transport(cls):
+        if Kraken._transport is None:
+            Kraken._transport = KrakenTransport()
+        return Kraken._transport
+
+    def get_cursor(self, stream):
+        """
+        Read the high-water mark of a history stream ('trades', 'ledgers' or 'closed_orders').
+
+        :return: a dict with the time and id of the newest row synced, or None
+        """
+        raw = self.red.get(CURSOR_KEY % (self.manager_user.id, stream))
+        return json.loads(raw) if raw else None
+
+    def set_cursor(self, stream, cursor):
+        self.red.set(CURSOR_KEY % (self.manager_user.id, stream), json.dumps(cursor))
+
+    def get_backfill_workers(self, cursor):
+        """
+        :return: the number of concurrent page fetches to use, more than one only when backfilling without a cursor
+        """
+        if cursor is not None:
+            return 1
+        return self.get_config('backfill_workers', BACKFILL_WORKERS, int)
+
+    def iter_pages(self, fetch, key, workers=1):
+        """
+        Page backwards through a Kraken history endpoint, newest rows first.
+
+        Once the first page has told us the total count, the remaining offsets are known,
+        so with more than one worker they are fetched concurrently, a batch of workers at a
+        time, and still yielded in order. Every request goes through the rate limiter, so
+        the backfill stays inside the API budget. Concurrent requests may reach Kraken out
+        of nonce order, so the API key should have a nonce window configured.
+
+        :param fetch: a function of the offset which requests one page
+        :param key: the key of the rows in the result, i.e. 'trades', 'ledger' or 'closed'
+        :param workers: the number of pages to fetch at once
+        :raise IOError: if a page could not be fetched
+        """
+        resp = fetch(0)
+        rows = page_rows(resp, key, 0)
+        if len(rows) == 0:
+            return
+        yield rows
+        offset = len(rows)
+        count = int(resp['result']['count'])
+        if workers <= 1 or count - offset <= len(rows):
+            while offset < count:
+                resp = fetch(offset)
+                rows = page_rows(resp, key, offset)
+                if len(rows) == 0:
+                    return
+                yield rows
+                offset += len(rows)
+                count = int(resp['result']['count'])
+            return
+        offsets = range(offset, count, len(rows))
+        pool = ThreadPool(workers)
+        try:
+            for i in range(0, len(offsets), workers):
+                batch = offsets[i:i + workers]
+                for ofs, resp in zip(batch, pool.map(fetch, batch)):
+                    rows = page_rows(resp, key, ofs)
+                    if len(rows) == 0:
+                        return
+                    yield rows
+        finally:
+            pool.terminate()
 
     def submit_private_request(self, method, params=None, retry=0):
-        """Submit request to Kraken"""
+        """
+        Submit request to Kraken.
+
+        The rate limiter is waited on before the nonce is drawn, so a request never sits
+        out a limiter wait holding an old nonce. Signing and sending are not serialised,
+        though, so requests from concurrent threads can still reach Kraken out of nonce
+        order, and the API key should have a nonce window configured when requests are
+        sent concurrently. An Invalid nonce reply is retried with a fresh nonce.
+
+        A timeout, connection error or 5xx reply is retried too, except for ORDER_METHODS:
+        Kraken may have placed the orders before the reply was lost, so None is returned
+        and the caller looks the orders up instead of sending them twice.
+        """
         if not params:
             params = {}
         path = '/0/private/%s' % method
+        resend = method not in ORDER_METHODS and retry < 3
 
-        params['nonce'] = int(time.time() * 1000)
-        data = urllib.urlencode(params)
+        self.get_rate_limiter().acquire(method)
+        try:
+            params['nonce'] = self.get_nonce()
+        except IOError as e:
+            self.logger.exception('%s while sending %r to kraken %s' % (e, params, path))
+            return
+        if method in JSON_METHODS:
+            data = json.dumps(params)
+        else:
+            data = urllib.urlencode(params)
         message = path + hashlib.sha256(str(params['nonce']) + data).digest()
         sign = base64.b64encode(hmac.new(base64.b64decode(self.secret),
                                          message, hashlib.sha512).digest())
@@ -44,23 +1167,33 @@ class Kraken(ExchangePluginBase):
             'API-Key': self.key,
             'API-Sign': sign
         }
+        if method in JSON_METHODS:
+            headers['Content-Type'] = 'application/json'
         try:
-            rawresp = requests.post(baseUrl + path, data=data, headers=headers, timeout=REQ_TIMEOUT)
-            response = rawresp.text
-        except (ConnectionError, ReadTimeout, Timeout) as e:
+            rawresp = self.get_transport().post(path, method, data=data, headers=headers)
+        except (ConnectionError, requests.ConnectionError, ReadTimeout, Timeout) as e:
             self.logger.exception('%s %s while sending %r to kraken %s' % (type(e), e, params, path))
-            if retry < 3:
+            if resend:
                 return self.submit_private_request(method, params=params, retry=retry + 1)
+            return
         if rawresp.status_code == 502 or rawresp.status_code == 520:
             self.logger.exception('%s error while sending %r to kraken %s' % (rawresp.status_code, params, path))
-            if retry < 3:
+            if resend:
                 return self.submit_private_request(method, params=params, retry=retry + 1)
+            elif method in ORDER_METHODS:
+                return
         try:
-            jresp = json.loads(response)
+            jresp = decode_response(rawresp.content)
         except ValueError as e:
-            self.logger.exception('%s %s while sending %r to kraken %s, response %s' % (type(e), e, params, path, response))
+            self.logger.exception('%s %s while sending %r to kraken %s, response %s' %
+                                  (type(e), e, params, path, rawresp.content))
             return
-        if "Invalid nonce" in response and retry < 3:
+        if has_error(jresp, "Invalid nonce") and retry < 3:
+            return self.submit_private_request(method, params=params, retry=retry + 1)
+        elif has_error(jresp, "EAPI:Rate limit exceeded") and retry < 3:
+            # EOrder:Rate limit exceeded is the matching engine's limit, not the API counter's,
+            # so it is returned to the caller rather than retried
+            self.get_rate_limiter().penalize()
             return self.submit_private_request(method, params=params, retry=retry + 1)
         else:
             return jresp
@@ -68,8 +1201,88 @@ class Kraken(ExchangePluginBase):
     @classmethod
     def submit_public_request(cls, method, params=None):
         path = '/0/public/%s' % method
-        data = urllib.urlencode(params)
-        return json.loads(requests.get(baseUrl + path + "?" + data, timeout=REQ_TIMEOUT).text)
+        data = urllib.urlencode(params or {})
+        return decode_response(cls.get_transport().get(path, method, data).content)
+
+    def load_metadata(self):
+        """
+        Load the exchange metadata and symbol table from the on-disk cache, refreshing it
+        from Kraken if it is missing or older than metadata_ttl. Stale metadata is still
+        used if the refresh fails, as the pairs and their precisions rarely change.
+        """
+        path = self.get_config('metadata_file', METADATA_FILE)
+        metadata = ExchangeMetadata.load(path)
+        if metadata is None or metadata.is_stale(self.get_config('metadata_ttl', METADATA_TTL, float)):
+            refreshed = self.refresh_metadata()
+            if refreshed is not None or metadata is None:
+                return refreshed
+        self.install_metadata(metadata)
+        return metadata
+
+    @classmethod
+    def install_metadata(cls, metadata):
+        """Make metadata the one used to round orders and name markets, dropping the names cached from the last."""
+        Kraken._metadata = metadata
+        Kraken._symbols = metadata.symbols
+        Kraken._markets = {}
+        Kraken._commodities = {}
+
+    def refresh_metadata(self):
+        """
+        Fetch Assets, AssetPairs and the fee tier from TradeVolume and cache them on disk.
+        If they can not be fetched the format methods keep their name heuristics.
+
+        :return: the new ExchangeMetadata, or None if it could not be fetched
+        """
+        try:
+            assets = self.submit_public_request('Assets')['result']
+            pairs = self.submit_public_request('AssetPairs')['result']
+        except Exception as e:
+            self.logger.exception(e)
+            return
+        fees = Kraken._metadata.fees if Kraken._metadata is not None else {}
+        markets = [m.strip() for m in self.get_config('markets', 'BTC_USD').split(',')]
+        try:
+            volume = self.submit_private_request('TradeVolume',
+                                                 {'pair': ','.join(self.unformat_market(m) for m in markets)})
+        except Exception as e:
+            self.logger.exception(e)
+            volume = None
+        if volume and 'result' in volume:
+            fees = volume['result']
+        metadata = ExchangeMetadata(assets, pairs, fees)
+        try:
+            metadata.save(self.get_config('metadata_file', METADATA_FILE))
+        except (IOError, OSError) as e:
+            self.logger.exception(e)
+        self.install_metadata(metadata)
+        return metadata
+
+    def start_metadata_refresh(self):
+        """
+        Refresh the exchange metadata every metadata_ttl seconds in a daemon thread, started
+        once per process. While the metadata is stale, because a refresh failed, it is tried
+        again every metadata_retry seconds.
+        """
+        if Kraken._metadata_refresh is not None and Kraken._metadata_refresh.is_alive():
+            return Kraken._metadata_refresh
+        ttl = self.get_config('metadata_ttl', METADATA_TTL, float)
+        retry = self.get_config('metadata_retry', METADATA_RETRY, float)
+
+        def refresh():
+            while True:
+                age = time.time() - Kraken._metadata.fetched if Kraken._metadata is not None else ttl
+                time.sleep(max(ttl - age, retry))
+                try:
+                    self.refresh_metadata()
+                except Exception as e:
+                    self.logger.exception(e)
+
+        thread = threading.Thread(target=refresh, name='kraken-metadata')
+        thread.daemon = True
+        thread.start()
+        Kraken._metadata_refresh = thread
+        return thread
 
     @classmethod
     def format_market(cls, market):
@@ -82,11 +1295,34 @@ class Kraken(ExchangePluginBase):
 
         :return: a market formated according to what bitcoin_exchanges expects.
         """
+        if Kraken._symbols is not None and market in Kraken._symbols.markets:
+            return Kraken._symbols.markets[market]
         middle = int(len(market) / 2)
         half1 = cls.format_commodity(market[:middle].strip("_"))
         half2 = cls.format_commodity(market[middle:].strip("_"))
         return "%s_%s" % (half1, half2)
 
+    @classmethod
+    def market_commodities(cls, pair):
+        """
+        :return: the (market, base, quote) of a Kraken pair, cached
+        """
+        found = Kraken._markets.get(pair)
+        if found is None:
+            market = cls.format_market(pair)
+            found = Kraken._markets[pair] = (market, cls.base_commodity(market), cls.quote_commodity(market))
+        return found
+
+    @classmethod
+    def cached_commodity(cls, asset):
+        """
+        :return: the commodity of a Kraken asset, cached
+        """
+        found = Kraken._commodities.get(asset)
+        if found is None:
+            found = Kraken._commodities[asset] = cls.format_commodity(asset)
+        return found
+
     @classmethod
     def unformat_market(cls, market):
         """
@@ -96,6 +1332,8 @@ class Kraken(ExchangePluginBase):
 
         :return: a market formated according to what kraken expects.
         """
+        if Kraken._symbols is not None and market in Kraken._symbols.pairs:
+            return Kraken._symbols.pairs[market]
         if "_" in market or len(market) == 8:
             middle = int(len(market) / 2)
             half1 = cls.unformat_commodity(market[:middle].strip("_"))
@@ -111,6 +1349,8 @@ class Kraken(ExchangePluginBase):
         If the data provided by the exchange does not match the default
         implementation, then this method must be re-implemented.
         """
+        if Kraken._symbols is not None and c in Kraken._symbols.commodities:
+            return Kraken._symbols.commodities[c]
         if len(c) > 3 and c[0] in "XZ":
             c = c[1:]
         if c == "XBT":
@@ -125,6 +1365,8 @@ class Kraken(ExchangePluginBase):
         implementation, then this method must be re-implemented.
         """
         c = c.strip('_')
+        if Kraken._symbols is not None and c in Kraken._symbols.assets:
+            return Kraken._symbols.assets[c]
         if len(c) == 4 and c[0] in "XY":
             return c
         elif len(c) == 3 and c[0] not in "XY":
@@ -133,100 +1375,282 @@ class Kraken(ExchangePluginBase):
             if c in FIAT_CURRENCIES:
                 return 'Z' + c
             else:
-                return 'X' + c
-        return c
+                return 'X' + c
+        return c
+
+    def get_book(self, market):
+        """
+        :return: the local order book of market, creating an empty one if needed
+        """
+        if self._books is None:
+            self._books = {}
+        if market not in self._books:
+            self._books[market] = OrderBook(market, depth=self.get_config('book_depth', BOOK_DEPTH, int))
+        return self._books[market]
+
+    def sync_book(self, market='BTC_USD'):
+        """
+        Reload the local order book of market from a fresh Depth snapshot and publish it.
+        The levels are written with the decimals of the websocket feed, or of the pair's
+        metadata before the feed has been seen, so the book's checksums keep matching.
+        """
+        book = self.get_book(market)
+        depth = self.get_order_book(market, count=book.asks.depth)
+        if book.price_decimals is None and Kraken._metadata is not None:
+            decimals = Kraken._metadata.book_decimals(self.unformat_market(market))
+            if decimals is not None:
+                book.price_decimals, book.volume_decimals = decimals
+        book.load_snapshot(book.format_levels(depth['asks']), book.format_levels(depth['bids']))
+        self.publish_book(book)
+        return book
+
+    def publish_book(self, book):
+        self.red.set('kraken_%s_book' % book.market, json.dumps(book.to_dict()))
+
+    def apply_book_message(self, msg):
+        """
+        Apply a snapshot or update message from Kraken's websocket book feed to the local book,
+        falling back to a Depth snapshot if the book checksum shows it is out of sync.
+
+        :return: the updated OrderBook
+        """
+        book = self.get_book(self.format_market(msg[-1].replace('/', '')))
+        checksum = None
+        for payload in msg[1:-2]:
+            if 'as' in payload or 'bs' in payload:
+                book.note_decimals(payload.get('as') or payload.get('bs'))
+                book.load_snapshot(payload.get('as', []), payload.get('bs', []))
+            else:
+                book.apply_levels(payload.get('a', []), payload.get('b', []))
+            checksum = payload.get('c', checksum)
+        if checksum is not None and int(checksum) != book.checksum():
+            self.logger.warning("kraken %s book out of sync, reloading snapshot" % book.market)
+            return self.sync_book(book.market)
+        self.publish_book(book)
+        return book
 
-    @classmethod
-    def sync_book(cls, market=None):
-        pass
+    def stream_books(self, markets):
+        """
+        Keep the local order books of markets up to date from Kraken's websocket book feed.
+        Requires the websocket-client package.
+        """
+        if websocket is None:
+            raise ImportError("stream_books requires the websocket-client package")
+        wsnames = Kraken._symbols.wsnames if Kraken._symbols is not None else {}
+        pairs = [wsnames.get(m, m.replace('BTC', 'XBT').replace('_', '/')) for m in markets]
+        ws = websocket.create_connection(wsUrl)
+        try:
+            ws.send(json.dumps({'event': 'subscribe', 'pair': pairs,
+                                'subscription': {'name': 'book',
+                                                 'depth': self.get_config('book_depth', BOOK_DEPTH, int)}}))
+            while True:
+                msg = json.loads(ws.recv())
+                if isinstance(msg, list):
+                    self.apply_book_message(msg)
+        finally:
+            ws.close()
 
-    def sync_ticker(self, market='BTC_USD'):
-        pair = self.unformat_market(market)
-        full_ticker = self.submit_public_request('Ticker', {'pair': pair})
-        ticker = full_ticker['result'][pair]
-        tick = em.Ticker(float(ticker['b'][0]),
+    @staticmethod
+    def make_ticker(ticker, market):
+        return em.Ticker(float(ticker['b'][0]),
                          float(ticker['a'][0]),
                          float(ticker['h'][1]),
                          float(ticker['l'][1]),
                          float(ticker['v'][1]),
                          float(ticker['c'][0]),
                          market, 'kraken')
+
+    def sync_ticker(self, market='BTC_USD'):
+        pair = self.unformat_market(market)
+        full_ticker = self.submit_public_request('Ticker', {'pair': pair})
+        tick = self.make_ticker(full_ticker['result'][pair], market)
         jtick = jsonify2(tick, 'Ticker')
         self.red.set('kraken_%s_ticker' % market, jtick)
         return tick
 
-    def sync_balances(self):
+    def sync_tickers(self, markets=None):
+        """
+        Fetch the tickers of several markets with a single Ticker request and publish
+        them all in one Redis pipeline.
+
+        :param markets: the markets to sync, by default the configured markets
+        :return: a list of the tickers
+        """
+        if markets is None:
+            markets = self.get_config('markets', 'BTC_USD').split(',')
+        pairs = dict((self.unformat_market(m.strip()), m.strip()) for m in markets)
+        full_ticker = self.submit_public_request('Ticker', {'pair': ','.join(pairs)})
+        ticks = []
+        pipe = self.red.pipeline(transaction=False)
+        for pair, ticker in full_ticker['result'].iteritems():
+            market = pairs.get(pair, self.format_market(pair))
+            tick = self.make_ticker(ticker, market)
+            pipe.set('kraken_%s_ticker' % market, jsonify2(tick, 'Ticker'))
+            ticks.append(tick)
+        pipe.execute()
+        return ticks
+
+    def run_tickers(self, markets=None, interval=None):
+        """
+        Sync the tickers of markets every interval seconds (ticker_interval in the config) until interrupted.
+        """
+        if interval is None:
+            interval = self.get_config('ticker_interval', TICKER_INTERVAL, float)
+        while True:
+            started = time.time()
+            try:
+                self.sync_tickers(markets)
+            except Exception as e:
+                self.logger.exception(e)
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    def reserved_balance(self, rawos):
+        """
+        :param rawos: the raw open orders, as returned by fetch_open_orders
+        :return: a Balance of the funds held by the open orders
+        """
+        reserved = {}
+        for o in rawos.itervalues():
+            pair = self.format_market(o['descr']['pair'])
+            remaining = Decimal(o['vol']) - Decimal(o['vol_exec'])
+            if o['descr']['type'] == 'buy':
+                commodity = self.quote_commodity(pair)
+                remaining *= Decimal(o['descr']['price'])
+            else:
+                commodity = self.base_commodity(pair)
+            reserved[commodity] = reserved.get(commodity, 0) + remaining
+        held = Balance()
+        for commodity, amount in reserved.iteritems():
+            held = held + decimal_amount(amount, commodity)
+        return held
+
+    @uses_session
+    def sync_balances(self, rawos=None):
+        """
+        Update the user's balances from Kraken, writing only the currencies whose
+        total or available amount changed.
+
+        :param rawos: an open orders snapshot to compute available funds from, fetched if not given
+        """
         tbal = self.submit_private_request('Balance')
-        if 'result' in tbal:
-            total = Balance()
+        total = Balance()
+        if tbal and 'result' in tbal:
             for cur in tbal['result']:
                 commodity = self.format_commodity(cur)
                 amount = Amount("{0} {1}".format(tbal['result'][cur], commodity))
                 total = total + amount
-        else:
-            total = Balance()
-        # self.logger.debug("total balance: %s" % total)
+        if rawos is None:
+            rawos = self.fetch_open_orders() or {}
         available = Balance(total)
-        oorders = self.get_open_orders()
-        for o in oorders:
-            o.load_commodities()
-            if o.side == 'bid':
-                available = available - o.price * o.amount.number()
-            else:
-                available = available - o.amount
-
-        # self.logger.debug("available balance: %s" % available)
-        bals = {}
+        for amount in self.reserved_balance(rawos):
+            available = available - amount
+        bals = dict((b.currency, b) for b in
+                    self.session.query(wm.Balance).filter(wm.Balance.user_id == self.manager_user.id))
+        changed = 0
         for amount in total:
             comm = str(amount.commodity)
-            bals[comm] = self.session.query(wm.Balance).filter(wm.Balance.user_id == self.manager_user.id) \
-                .filter(wm.Balance.currency == comm).one_or_none()
-            if not bals[comm]:
-                bals[comm] = wm.Balance(amount, available.commodity_amount(amount.commodity), comm, "",
-                                        self.manager_user.id)
-                self.session.add(bals[comm])
+            avail = available.commodity_amount(amount.commodity)
+            bal = bals.get(comm)
+            if bal is None:
+                self.session.add(wm.Balance(amount, avail, comm, "", self.manager_user.id))
+                changed += 1
+                continue
+            bal.load_commodities()
+            if bal.total != amount or bal.available != avail:
+                bal.total = amount
+                bal.available = avail
+                changed += 1
+        if changed > 0:
+            self.get_writes().commit()
+
+    def get_closed_orders(self, begin=None, tend=None, offset=None):
+        params = {'trades': 'False', 'closetime': 'close'}
+        if begin is not None:
+            params['start'] = str(begin)
+        if tend is not None:
+            params['end'] = str(tend)
+        if offset is not None:
+            params['ofs'] = str(offset)
+        return self.submit_private_request('ClosedOrders', params)
+
+    def ingest_closed_orders(self, rawos):
+        """
+        Store a page of ClosedOrders, looking up the known orders in one query. Unknown
+        orders are added and known ones have their state and exec amount updated.
+
+        :return: the number of orders added
+        """
+        ids = ['kraken|%s' % id for id in rawos]
+        known = {}
+        if len(ids) > 0:
+            known = dict((lo.order_id, lo) for lo in
+                         self.session.query(em.LimitOrder).filter(em.LimitOrder.order_id.in_(ids)))
+        new = []
+        for id, o in rawos.iteritems():
+            rec = OrderRecord.decode(id, o, self.market_commodities)
+            lo = known.get('kraken|%s' % id)
+            if lo is None:
+                new.append(em.LimitOrder(rec.avg_price, rec.remaining(), rec.market, rec.side, 'kraken',
+                                         exec_amount=rec.vol_exec, state='closed', order_id='kraken|%s' % id))
             else:
-                bals[comm].load_commodities()
-                bals[comm].total = amount
-                bals[comm].available = available.commodity_amount(amount.commodity)
+                lo.state = 'closed'
+                lo.exec_amount = rec.vol_exec
+                lo.load_commodities()
+        self.session.add_all(new)
+        # flush the page and let go of its new orders, so a rescan holds one page at a time
+        self.session.flush()
+        for lo in new:
+            self.session.expunge(lo)
+        return len(new)
+
+    @uses_session
+    def sync_orders(self, rescan=False):
+        """
+        Page through the orders closed since the closed orders cursor, or all of them if
+        rescan is True. Pages are committed through the write-behind, and all of them
+        before the cursor moves.
+        """
+        cursor = None if rescan else self.get_cursor('closed_orders')
+        begin = cursor['id'] if cursor is not None else None
+        newest = cursor
+        self.get_writes().flush()  # a failed page's rollback must not discard other operations' writes
         try:
-            self.session.commit()
+            for rawos in self.iter_pages(lambda ofs: self.get_closed_orders(begin=begin, offset=ofs), 'closed',
+                                         workers=self.get_backfill_workers(cursor)):
+                self.ingest_closed_orders(rawos)
+                if not self.get_writes().commit():
+                    return
+                newest = newest_cursor(rawos, newest, 'closetm')
+        except (IOError, ValueError) as e:
+            self.logger.exception(e)
+            self.get_writes().flush()
+            return
         except Exception as e:
             self.logger.exception(e)
-            self.session.rollback()
-            self.session.flush()
-
-    def sync_orders(self):
-        orders = self.submit_private_request('ClosedOrders', {'trades': 'False'})
-        if 'result' in orders and 'closed' in orders['result']:
-            rawos = orders['result']['closed']
-            for id, o in rawos.iteritems():
-                side = 'ask' if o['descr']['type'] == 'sell' else 'bid'
-                base = self.base_commodity(o['descr']['pair'])
-                quote = self.quote_commodity(o['descr']['pair'])
-                amount = Amount("%s %s" % (o['vol'], base)) - Amount("%s %s" % (o['vol_exec'], base))
-                lo = get_order_by_order_id(id, 'kraken', session=self.session)
-                # TODO update state and exec amount
-                if lo is None:
-                    lo = em.LimitOrder(Amount("%s %s" % (o['price'], quote)), amount,
-                                       self.format_market(o['descr']['pair']), side, 'kraken',
-                                       state='closed', order_id='kraken|%s' % id)
-                    self.session.add(lo)
-            try:
-                self.session.commit()
-            except Exception as e:
-                self.logger.exception(e)
-                self.session.rollback()
-                self.session.flush()
-        return orders
+            self.get_writes().rollback()
+            return
+        if self.get_writes().flush() and newest is not cursor:
+            self.set_cursor('closed_orders', newest)
 
     @classmethod
-    def get_order_book(cls, market='BTC_USD'):
+    def get_order_book(cls, market='BTC_USD', count=None):
         market = cls.unformat_market(market)
-        book = cls.submit_public_request('Depth', {'pair': market})
+        params = {'pair': market}
+        if count is not None:
+            params['count'] = count
+        book = cls.submit_public_request('Depth', params)
         return book['result'][market]
 
+    @classmethod
+    def get_depth_book(cls, market='BTC_USD', count=None):
+        """
+        :return: a DepthBook of a fresh Depth snapshot of market
+        """
+        depth = cls.get_order_book(market, count=count)
+        return DepthBook(market, depth['asks'], depth['bids'])
+
     # private methods
+    @uses_session
     def cancel_order(self, oid=None, order_id=None, order=None):
         if order is None and oid is not None:
             order = self.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
@@ -235,16 +1659,18 @@ class Kraken(ExchangePluginBase):
         elif order is None:
             return
         resp = self.submit_private_request('CancelOrder', {'txid': order.order_id.split("|")[1]})
+        self.apply_cancel_order(order, resp)
+
+    @uses_session
+    def apply_cancel_order(self, order, resp):
+        """Close order locally if the CancelOrder response confirms it was cancelled."""
         if resp and 'result' in resp and 'count' in resp['result'] and resp['result']['count'] > 0:
             order.state = 'closed'
             order.order_id = order.order_id.replace('tmp', 'kraken')
-            try:
-                self.session.commit()
-            except Exception as e:
-                self.logger.exception(e)
-                self.session.rollback()
-                self.session.flush()
+            self.patch_open_orders(removed=[order.order_id.split("|")[1]])
+            self.get_writes().commit(now=True)
 
+    @uses_session
     def cancel_orders(self, oid=None, order_id=None, market=None, side=None, price=None):
         if oid is not None or order_id is not None:
             order = self.session.query(em.LimitOrder)
@@ -255,19 +1681,53 @@ class Kraken(ExchangePluginBase):
                 order = get_order_by_order_id(order_id, 'kraken', session=self.session)
             self.cancel_order(order=order)
         else:
+            started = time.time()
             orders = self.get_open_orders(market=market)
-            for o in orders:
-                if market is not None and market != o.market:
-                    continue
-                if side is not None and side != o.side:
-                    continue
-                if price is not None:
-                    if o.side == 'bid' and o.price < price:
+            if len(orders) == 0:
+                cancelled = []
+            elif market is None and side is None and price is None:
+                resp = self.submit_private_request('CancelAll')
+                cancelled = orders if resp and 'result' in resp else []
+            else:
+                matched = []
+                for o in orders:
+                    if market is not None and market != o.market:
                         continue
-                    elif o.side == 'ask' and o.price > price:
+                    if side is not None and side != o.side:
                         continue
-                self.cancel_order(order=o)
+                    if price is not None:
+                        if o.side == 'bid' and o.price < price:
+                            continue
+                        elif o.side == 'ask' and o.price > price:
+                            continue
+                    matched.append(o)
+                cancelled = self.cancel_order_batch(matched)
+            for o in cancelled:
+                o.state = 'closed'
+            self.patch_open_orders(removed=[o.order_id.split("|")[1] for o in cancelled])
+            self.get_writes().commit(now=True)
+            self.logger.info("cancelled %s kraken orders in %.3fs" % (len(cancelled), time.time() - started))
+
+    def cancel_order_batch(self, orders):
+        """
+        Cancel orders with CancelOrderBatch, up to 50 at a time. When Kraken cancels fewer
+        orders than requested the local orders are reconciled with OpenOrders instead.
 
+        :return: the orders which were cancelled, not yet closed locally
+        """
+        cancelled = []
+        for i in range(0, len(orders), CANCEL_BATCH_SIZE):
+            batch = orders[i:i + CANCEL_BATCH_SIZE]
+            resp = self.submit_private_request('CancelOrderBatch',
+                                               {'orders': [o.order_id.split("|")[1] for o in batch]})
+            if resp and 'result' in resp and resp['result'].get('count', 0) == len(batch):
+                cancelled.extend(batch)
+            elif resp and 'result' in resp:
+                self.invalidate_open_orders()
+                self.get_open_orders()
+        return cancelled
+
+    @uses_session
     def create_order(self, oid, expire=None):
         order = self.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
         if not order:
@@ -275,61 +1735,239 @@ class Kraken(ExchangePluginBase):
             if expire is not None and expire < time.time():
                 submit_order('kraken', oid, expire=expire)  # back of the line!
             return
-        market = self.unformat_market(order.market)
-        amount = str(order.amount.number()) if isinstance(order.amount, Amount) else str(order.amount)
-        price = str(order.price.number()) if isinstance(order.price, Amount) else str(order.price)
-        side = 'buy' if order.side == 'bid' else 'sell'
-        options = {'type': side, 'volume': amount, 'price': price, 'pair': market, 'ordertype': 'limit'}
+        try:
+            options = self.order_options(order)
+        except ValueError as e:
+            self.logger.warning("kraken order %s is invalid: %s" % (oid, e))
+            return
         resp = None
         try:
             resp = self.submit_private_request('AddOrder', options)
         except Exception as e:
             self.logger.exception(e)
+        return self.apply_add_order(order, options, resp)
+
+    def order_options(self, order):
+        """
+        :return: the AddOrder parameters for a local limit order, rounded to the pair's precision
+        :raise ValueError: if the order is below the pair's minimum size
+        """
+        market = self.unformat_market(order.market)
+        amount = str(order.amount.number()) if isinstance(order.amount, Amount) else str(order.amount)
+        price = str(order.price.number()) if isinstance(order.price, Amount) else str(order.price)
+        side = 'buy' if order.side == 'bid' else 'sell'
+        if Kraken._metadata is not None:
+            price, amount = Kraken._metadata.round_order(market, side, price, amount)
+        return {'type': side, 'volume': amount, 'price': price, 'pair': market, 'ordertype': 'limit',
+                'userref': order.id}
+
+    @uses_session
+    def apply_add_order(self, order, options, resp, commit=True):
+        """
+        Open order locally with the txid from an AddOrder response.
+
+        :param commit: False to leave committing to the caller, as create_orders does
+        :return: the order if Kraken accepted it, otherwise None
+        """
         if resp is None or 'error' in resp and len(resp['error']) > 0:
             self.logger.warning('kraken unable to create order %r for reason %r' % (options, resp))
             # Do nothing. The order can stay locally "pending" and be retried, if desired.
         elif 'result' in resp and 'txid' in resp['result'] and len(resp['result']['txid']) > 0:
             order.order_id = 'kraken|%s' % resp['result']['txid'][0]
             order.state = 'open'
+            self.patch_open_orders(added={resp['result']['txid'][0]: {
+                'descr': {'pair': options['pair'], 'type': options['type'], 'price': options['price']},
+                'vol': options['volume'], 'vol_exec': '0', 'userref': options.get('userref')}})
             self.logger.debug("submitted order %s" % order)
-            try:
-                self.session.commit()
-            except Exception as e:
-                self.logger.exception(e)
-                self.session.rollback()
-                self.session.flush()
+            if commit:
+                self.get_writes().commit(now=True)
             return order
 
-    def get_open_orders(self, market=None):
-        oorders = self.submit_private_request('OpenOrders', {'trades': 'True'})
-        orders = []
+    @uses_session
+    def create_orders(self, oids):
+        """
+        Submit many pending orders at once. The orders are loaded in one query and sent
+        through AddOrderBatch, grouped by pair in batches of up to 15, then committed once.
+        An order Kraken rejects stays pending without failing the rest of its batch.
 
-        if 'result' in oorders and 'open' in oorders['result']:
-            rawos = oorders['result']['open']
-            for id, o in rawos.iteritems():
-                side = 'ask' if o['descr']['type'] == 'sell' else 'bid'
-                pair = self.format_market(o['descr']['pair'])
-                base = self.base_commodity(pair)
-                amount = Amount("%s %s" % (o['vol'], base)) - Amount("%s %s" % (o['vol_exec'], base))
-                quote = self.quote_commodity(pair)
-                if market is None or pair == self.format_market(market):
-                    try:
-                        lo = get_order_by_order_id(id, 'kraken', session=self.session)
-                    except Exception as e:
-                        self.logger.exception(e)
-                    if lo is None:
-                        lo = em.LimitOrder(Amount("%s %s" % (o['descr']['price'], quote)), amount, pair, side,
-                                           self.NAME, str(id), exec_amount=Amount("0 %s" % base), state='open')
-                        self.session.add(lo)
-                    else:
-                        lo.state = 'open'
-                    orders.append(lo)
+        :return: a list of the orders which were opened
+        """
+        orders = self.session.query(em.LimitOrder).filter(em.LimitOrder.id.in_(oids)).all()
+        missing = set(oids) - set(o.id for o in orders)
+        if len(missing) > 0:
+            self.logger.warning("unable to find orders %s" % sorted(missing))
+        groups = {}
+        for order in orders:
+            try:
+                options = self.order_options(order)
+            except ValueError as e:
+                self.logger.warning("kraken order %s is invalid: %s" % (order.id, e))
+                continue
+            groups.setdefault(options['pair'], []).append((order, options))
+        opened = []
+        for pair, group in groups.iteritems():
+            for i in range(0, len(group), ORDER_BATCH_SIZE):
+                opened.extend(self.submit_order_batch(pair, group[i:i + ORDER_BATCH_SIZE]))
+        if len(opened) > 0 and not self.get_writes().commit(now=True):
+            return []
+        return opened
+
+    def submit_order_batch(self, pair, batch):
+        """
+        Send a batch of (order, AddOrder options) of one pair with AddOrderBatch. If Kraken
+        rejects the batch as a whole its orders are sent one at a time instead. If the
+        outcome is unknown (a timeout, server error or unreadable response) Kraken may
+        have accepted the batch, so nothing is resent: the orders are looked up by userref
+        with recover_order_batch, and those not found stay pending.
+
+        :return: a list of the orders which were opened, not yet committed
+        """
+        if len(batch) == 1:
+            return self.submit_orders_singly(batch)
+        params = {'pair': pair, 'orders': [dict((k, v) for k, v in options.iteritems() if k != 'pair')
+                                           for order, options in batch]}
+        submitted = time.time()
         try:
-            self.session.commit()
+            resp = self.submit_private_request('AddOrderBatch', params)
         except Exception as e:
             self.logger.exception(e)
-            self.session.rollback()
-            self.session.flush()
+            resp = None
+        if resp is not None and len(resp.get('error') or []) > 0:
+            self.logger.warning('kraken rejected order batch for %s: %r' % (pair, resp))
+            return self.submit_orders_singly(batch)
+        if resp is None or 'result' not in resp:
+            self.logger.warning('kraken order batch for %s has an unknown outcome: %r' % (pair, resp))
+            return self.recover_order_batch(batch, submitted)
+        opened = []
+        for (order, options), result in zip(batch, resp['result'].get('orders', [])):
+            if 'txid' not in result:
+                self.logger.warning('kraken unable to create order %r for reason %r' % (options, result))
+                continue
+            self.apply_add_order(order, options, {'error': [], 'result': {'txid': [result['txid']]}}, commit=False)
+            opened.append(order)
+        return opened
+
+    def submit_orders_singly(self, batch):
+        """
+        Send a batch of (order, AddOrder options) one AddOrder at a time.
+
+        :return: a list of the orders which were opened, not yet committed
+        """
+        opened = []
+        for order, options in batch:
+            try:
+                single = self.submit_private_request('AddOrder', options)
+            except Exception as e:
+                self.logger.exception(e)
+                single = None
+            if self.apply_add_order(order, options, single, commit=False) is not None:
+                opened.append(order)
+        return opened
+
+    def recover_order_batch(self, batch, submitted):
+        """
+        Find the orders of a batch with an unknown outcome on Kraken, by their userref, in a
+        fresh OpenOrders and the orders closed since the batch was submitted. Found orders
+        take their txid, and the rest stay pending, to be resubmitted later.
+
+        :return: a list of the orders which were found open, not yet committed
+        """
+        self.invalidate_open_orders()
+        rawos = self.fetch_open_orders(max_age=0)
+        closed = self.get_closed_orders(begin=int(submitted) - 1)
+        if rawos is None or not closed or 'result' not in closed:
+            self.logger.warning('unable to look up kraken order batch %s, leaving it pending' %
+                                [order.id for order, options in batch])
+            return []
+        open_refs = dict((o.get('userref'), txid) for txid, o in rawos.iteritems())
+        closed_refs = dict((o.get('userref'), txid) for txid, o in closed['result'].get('closed', {}).iteritems())
+        opened = []
+        for order, options in batch:
+            if order.id in open_refs:
+                self.apply_add_order(order, options, {'error': [], 'result': {'txid': [open_refs[order.id]]}},
+                                     commit=False)
+                opened.append(order)
+            elif order.id in closed_refs:
+                order.order_id = 'kraken|%s' % closed_refs[order.id]
+                order.state = 'closed'
+            else:
+                self.logger.warning('kraken order %s was not found after its batch, leaving it pending' % order.id)
+        return opened
+
+    def fetch_open_orders(self, max_age=None):
+        """
+        Serve the raw OpenOrders of the account from a short-lived snapshot, fetching
+        a new one if it is older than max_age seconds (open_orders_ttl in the config).
+
+        :return: the raw open orders by txid, or None if they could not be fetched
+        """
+        if max_age is None:
+            max_age = self.get_config('open_orders_ttl', OPEN_ORDERS_TTL, float)
+        snapshot = self._open_orders
+        if snapshot is not None and time.time() - snapshot[0] <= max_age:
+            return snapshot[1]
+        stamp = time.time()
+        oorders = self.submit_private_request('OpenOrders', {'trades': 'True'})
+        if oorders and 'result' in oorders and 'open' in oorders['result']:
+            self._open_orders = (stamp, oorders['result']['open'])
+            return oorders['result']['open']
+        self._open_orders = None
+
+    def patch_open_orders(self, added=None, removed=None):
+        """
+        Apply a successful order placement or cancellation to the open orders snapshot,
+        so reads within its TTL stay correct without another OpenOrders request.
+        """
+        snapshot = self._open_orders
+        if snapshot is None:
+            return
+        rawos = dict(snapshot[1])
+        rawos.update(added or {})
+        for txid in removed or []:
+            rawos.pop(txid, None)
+        self._open_orders = (snapshot[0], rawos)
+
+    def invalidate_open_orders(self):
+        self._open_orders = None
+
+    @uses_session
+    def get_open_orders(self, market=None):
+        """
+        Reconcile the local kraken orders with Kraken's open orders in a constant number of queries.
+        Unknown open orders are inserted, known ones marked open, and local open orders which
+        are no longer open on Kraken are closed.
+
+        :return: the open orders, of market if given
+        """
+        rawos = self.fetch_open_orders()
+        if rawos is None:
+            return []
+        local = dict((lo.order_id, lo) for lo in self.session.query(em.LimitOrder)
+                     .filter(em.LimitOrder.order_id.like('kraken|%'))
+                     .filter(em.LimitOrder.state == 'open'))
+        missing = ['kraken|%s' % id for id in rawos if 'kraken|%s' % id not in local]
+        if len(missing) > 0:
+            for lo in self.session.query(em.LimitOrder).filter(em.LimitOrder.order_id.in_(missing)):
+                local[lo.order_id] = lo
+        if market is not None:
+            market = self.format_market(market)
+        orders = []
+        new = []
+        for id, o in rawos.iteritems():
+            rec = OrderRecord.decode(id, o, self.market_commodities)
+            lo = local.pop('kraken|%s' % id, None)
+            if lo is None:
+                lo = em.LimitOrder(rec.price, rec.remaining(), rec.market, rec.side, self.NAME, str(id),
+                                   exec_amount=0, state='open')
+                new.append(lo)
+            else:
+                lo.state = 'open'
+            if market is None or rec.market == market:
+                orders.append(lo)
+        for lo in local.itervalues():
+            lo.state = 'closed'
+        self.session.add_all(new)
+        self.get_writes().commit()
         return orders
 
     def get_trades_history(self, begin=None, tend=None, market=None, offset=None):
@@ -343,60 +1981,155 @@ class Kraken(ExchangePluginBase):
             params['ofs'] = str(offset)
         return self.submit_private_request('TradesHistory', params)
 
+    def get_known_ids(self, model, column):
+        """
+        The KnownIds index of the kraken ids stored in column, warmed with one scan on first use.
+
+        Every commit inserting rows of model counts up a shared version in Redis (see
+        note_known_ids_committed), so when another process has inserted rows since the
+        index was warmed it is marked behind, and lookups ask the database about the ids
+        it does not hold rather than the whole table being scanned again.
+
+        :return: the KnownIds of model
+        """
+        version = int(self.red.get(KNOWN_IDS_KEY % model.__name__) or 0)
+        index = Kraken._known_ids.get(model.__name__)
+        if index is not None and index.version != version:
+            index.behind = True
+        if index is None or index.bloom.is_full():
+            refs = [row[0] for row in self.session.query(column).filter(column.like('kraken|%')).yield_per(10000)]
+            index = KnownIds(len(refs), max_ids=self.get_config('known_ids_max', KNOWN_IDS_MAX, int),
+                             version=version)
+            for ref in refs:
+                index.add(ref)
+            Kraken._known_ids[model.__name__] = index
+            self.logger.debug("indexed %s known kraken %s ids" % (index.bloom.count, model.__name__))
+        return index
+
+    def note_known_ids_committed(self, *models):
+        """
+        Count up the shared version of models after this process committed new rows of them.
+        An index which was current stays current, as it already holds those rows; if another
+        process committed in between, the index is behind.
+        """
+        for model in models:
+            version = self.red.incr(KNOWN_IDS_KEY % model.__name__)
+            index = Kraken._known_ids.get(model.__name__)
+            if index is not None and index.version == version - 1:
+                index.version = version
+            elif index is not None:
+                index.behind = True
+
+    def forget_known_ids(self, *models):
+        """Drop the known id indexes of models, or all of them, so they are warmed again from the database."""
+        if len(models) == 0:
+            Kraken._known_ids = {}
+        for model in models:
+            Kraken._known_ids.pop(model.__name__, None)
+
+    def lookup_known_ids(self, model, column, refs):
+        """
+        :return: the set of refs stored in column, asking the database only about the refs the index can not settle
+        """
+        if len(refs) == 0:
+            return set()
+        index = self.get_known_ids(model, column)
+        known, maybe = index.split(refs)
+        if len(maybe) > 0:
+            for row in self.session.query(column).filter(column.in_(maybe)):
+                index.add(row[0])
+                known.add(row[0])
+        return known
+
+    def known_trade_ids(self, trade_ids):
+        """
+        Look up which of a page of Kraken trade ids are already stored, through the known id index.
+
+        :return: the set of stored trade_id values, prefixed with 'kraken|'
+        """
+        return self.lookup_known_ids(em.Trade, em.Trade.trade_id, ['kraken|%s' % tid for tid in trade_ids])
+
+    def iter_trade_pages(self, begin=None, tend=None, market=None, workers=1):
+        """
+        Lazily page through TradesHistory, newest first, fetching a page only when the previous one is consumed.
+
+        :return: a generator of lists of TradeRecord, one per page
+        :raise IOError: if a page could not be fetched
+        """
+        for rows in self.iter_pages(lambda ofs: self.get_trades_history(begin=begin, tend=tend, market=market,
+                                                                        offset=ofs), 'trades', workers=workers):
+            yield [TradeRecord.decode(tid, row, self.market_commodities) for tid, row in rows.iteritems()]
+
+    def iter_trades(self, begin=None, tend=None, market=None):
+        """
+        :return: a generator of TradeRecord, newest page first, holding only one page in memory
+        """
+        for records in self.iter_trade_pages(begin=begin, tend=tend, market=market):
+            for rec in records:
+                yield rec
+
+    def ingest_trades(self, records):
+        """
+        Bulk insert the unknown trades of a page of TradeRecord. The rows are flushed with
+        the page and never held by the session, so memory stays flat over any history.
+
+        :return: the number of trades added
+        """
+        known = self.known_trade_ids([rec.id for rec in records])
+        new = []
+        for rec in records:
+            if 'kraken|%s' % rec.id in known:
+                continue
+            dtime = datetime.datetime.fromtimestamp(float(rec.time))
+            new.append(em.Trade(rec.id, 'kraken', rec.market, rec.side, float(rec.vol), float(rec.price),
+                                float(rec.fee), 'quote', dtime))
+        self.logger.debug("%s of %s trades already known" % (len(known), len(records)))
+        if len(new) > 0:
+            self.session.bulk_save_objects(new)
+            self.session.flush()
+            index = self.get_known_ids(em.Trade, em.Trade.trade_id)
+            for trade in new:
+                index.add(trade.trade_id)
+        return len(new)
+
+    @uses_session
     def sync_trades(self, market=None, rescan=False):
-        offset = 0
-        lastoffset = -1
-        lastsleep = 4
-        trades = None
-        changed = False
-        while offset != lastoffset:
-            self.logger.debug("begin offset\t%s\nlastoffset\t%s" % (offset, lastoffset))
-            try:
-                trades = self.get_trades_history(market=market, offset=offset)
-            except (IOError, ValueError) as e:
-                if "ReadTimeout" in str(e):
-                    lastsleep *= 2
-                    time.sleep(lastsleep)
-                    continue
-                return
-            if not trades or 'result' not in trades or trades['result']['count'] == 0:
-                self.logger.debug("; non-interesting trades %s" % trades)
-                if "error" in trades and len(trades['error']) > 0 and \
-                        "Rate limit exceeded" in trades['error'][0]:
-                    lastsleep *= 1.5
-                    time.sleep(lastsleep)
-                    continue
-                elif "error" in trades and len(trades['error']) > 0 and \
-                        "Invalid nonce" in trades['error'][0]:
-                    time.sleep(30)
-                    continue
-                return
-            if lastsleep > 1:
-                lastsleep *= 0.975
-            lastoffset = offset
-            for tid in trades['result']['trades']:
-                lastoffset = offset
-                if rescan:
-                    offset += 1
-                found = self.session.query(em.Trade) \
-                    .filter(em.Trade.trade_id == 'kraken|%s' % tid) \
-                    .count()
-                if found != 0:
-                    self.logger.debug("%s already known" % tid)
-                    continue
-                row = trades['result']['trades'][tid]
-                dtime = datetime.datetime.fromtimestamp(float(row['time']))
-                market = self.format_market(row['pair'])
-                price = float(row['price'])
-                amount = float(row['vol'])
-                fee = float(row['fee'])
-                side = row['type']
-                trade = em.Trade(tid, 'kraken', market, side, amount, price, fee, 'quote', dtime)
-                self.session.add(trade)
-                changed = True
-                self.logger.debug("end offset\t%s\nlastoffset\t%s" % (offset, lastoffset))
-        if changed:
-            self.session.commit()
+        """
+        Fetch the trades newer than the trades cursor, or the whole history if rescan is True.
+        A rescan also warms the known trade ids again, to see rows changed by other processes.
+        """
+        if rescan:
+            self.forget_known_ids(em.Trade)
+        cursor = None if rescan else self.get_cursor('trades')
+        begin = cursor['id'] if cursor is not None else None
+        newest = cursor
+        added = 0
+        started = time.time()
+        self.get_writes().flush()  # a failed page's rollback must not discard other operations' writes
+        try:
+            for records in self.iter_trade_pages(begin=begin, market=market,
+                                                 workers=self.get_backfill_workers(cursor)):
+                added += self.ingest_trades(records)
+                newest = newest_record(records, newest)
+        except (IOError, ValueError) as e:
+            self.logger.exception(e)
+            newest = cursor
+        except Exception as e:
+            # the flushed pages are rolled back, so their ids must leave the index too
+            self.logger.exception(e)
+            self.get_writes().rollback()
+            self.forget_known_ids(em.Trade)
+            return
+        if added > 0 and not self.get_writes().commit(now=True):
+            self.forget_known_ids(em.Trade)
+            newest = cursor
+        elif added > 0:
+            self.note_known_ids_committed(em.Trade)
+        if newest is not cursor:
+            self.set_cursor('trades', newest)
+        elapsed = time.time() - started
+        self.logger.info("synced %s new trades in %.2fs (%.1f trades/s)" %
+                         (added, elapsed, added / elapsed if elapsed > 0 else 0))
 
     def get_ledgers(self, ltype='all', begin=None, tend=None, ofs=None):
         params = {'type': ltype}
@@ -408,110 +2141,276 @@ class Kraken(ExchangePluginBase):
             params['ofs'] = str(ofs)
         return self.submit_private_request('Ledgers', params)
 
+    def known_ledger_ids(self, model, ledger_ids):
+        """
+        Look up which of a page of Kraken ledger ids are already stored as model (wm.Credit or wm.Debit),
+        through the known id index.
+
+        :return: the set of stored ref_id values, prefixed with 'kraken|'
+        """
+        return self.lookup_known_ids(model, model.ref_id, ['kraken|%s' % lid for lid in ledger_ids])
+
+    def iter_ledger_pages(self, ltype='all', begin=None, tend=None, workers=1):
+        """
+        Lazily page through Ledgers, newest first, fetching a page only when the previous one is consumed.
+
+        :return: a generator of lists of LedgerRecord, one per page
+        :raise IOError: if a page could not be fetched
+        """
+        for rows in self.iter_pages(lambda ofs: self.get_ledgers(ltype=ltype, begin=begin, tend=tend, ofs=ofs),
+                                    'ledger', workers=workers):
+            yield [LedgerRecord.decode(lid, row, self.cached_commodity) for lid, row in rows.iteritems()]
+
+    def iter_ledger_entries(self, ltype='all', begin=None, tend=None):
+        """
+        :return: a generator of LedgerRecord, newest page first, holding only one page in memory
+        """
+        for records in self.iter_ledger_pages(ltype=ltype, begin=begin, tend=tend):
+            for rec in records:
+                yield rec
+
+    def ingest_ledgers(self, records):
+        """
+        Bulk insert the unknown deposits and withdrawals of a page of LedgerRecord as credits
+        and debits. The rows are flushed with the page and never held by the session.
+
+        :return: the number of credits and debits added
+        """
+        deposits = [rec for rec in records if rec.type == 'deposit']
+        withdrawals = [rec for rec in records if rec.type == 'withdrawal']
+        known = (self.known_ledger_ids(wm.Credit, [rec.id for rec in deposits]) |
+                 self.known_ledger_ids(wm.Debit, [rec.id for rec in withdrawals]))
+        new = []
+        for rec in deposits + withdrawals:
+            if 'kraken|%s' % rec.id in known:
+                continue
+            dtime = datetime.datetime.fromtimestamp(float(rec.time))
+            if rec.type == 'deposit':
+                new.append(wm.Credit(rec.amount, rec.refid, rec.asset, "kraken", "complete", "kraken",
+                                     "kraken|%s" % rec.id, self.manager_user.id, dtime))
+            else:
+                new.append(wm.Debit(rec.amount, rec.fee, rec.refid, rec.asset, "kraken", "complete", "kraken",
+                                    "kraken|%s" % rec.id, self.manager_user.id, dtime))
+        if len(new) > 0:
+            self.session.bulk_save_objects(new)
+            self.session.flush()
+            for entry in new:
+                model = type(entry)
+                self.get_known_ids(model, model.ref_id).add(entry.ref_id)
+        return len(new)
+
+    @uses_session
+    def sync_ledgers(self, rescan=False):
+        """
+        Ingest deposits as credits and withdrawals as debits from a single pass over the Ledgers endpoint.
+        Only entries newer than the ledgers cursor are fetched, unless rescan is True, which
+        also warms the known credit and debit ids again.
+        """
+        if rescan:
+            self.forget_known_ids(wm.Credit, wm.Debit)
+        cursor = None if rescan else self.get_cursor('ledgers')
+        begin = cursor['id'] if cursor is not None else None
+        newest = cursor
+        added = 0
+        failed = False
+        self.get_writes().flush()  # a failed page's rollback must not discard other operations' writes
+        try:
+            for records in self.iter_ledger_pages(begin=begin, workers=self.get_backfill_workers(cursor)):
+                added += self.ingest_ledgers(records)
+                newest = newest_record(records, newest)
+        except (IOError, ValueError) as e:
+            self.logger.exception(e)
+            newest = cursor
+            failed = True
+        except Exception as e:
+            self.logger.exception(e)
+            self.get_writes().rollback()
+            self.forget_known_ids(wm.Credit, wm.Debit)
+            return
+        if added > 0 and not self.get_writes().commit(now=True):
+            self.forget_known_ids(wm.Credit, wm.Debit)
+            newest = cursor
+            failed = True
+        elif added > 0:
+            self.note_known_ids_committed(wm.Credit, wm.Debit)
+        if newest is not cursor:
+            self.set_cursor('ledgers', newest)
+        if not failed:
+            self._ledgers_synced = (time.time(), rescan, dict((model.__name__, self.count_ledger_rows(model))
+                                                              for model in (wm.Credit, wm.Debit)))
+
+    def count_ledger_rows(self, model):
+        return self.session.query(model).filter(model.ref_id.like('kraken|%')).count()
+
+    @uses_session
+    def sync_recent_ledgers(self, model, rescan=False):
+        """
+        Run sync_ledgers unless a pass covering the request completed in the last ledger_sync_reuse
+        seconds and the stored rows of model have not changed since. The manager sends sync_credits
+        and sync_debits back to back, and one pass of the Ledgers endpoint answers both.
+        """
+        synced = self._ledgers_synced
+        if synced is not None and (synced[1] or not rescan) and \
+                time.time() - synced[0] <= self.get_config('ledger_sync_reuse', LEDGER_SYNC_REUSE, float) and \
+                self.count_ledger_rows(model) == synced[2][model.__name__]:
+            self.logger.debug("reusing the kraken ledgers pass from %.1fs ago" % (time.time() - synced[0]))
+            return
+        self.sync_ledgers(rescan=rescan)
+
     def sync_credits(self, rescan=False):
-        offset = 0
-        lastoffset = -1
-        lastsleep = 2
-        changed = False
-        while offset != lastoffset:
-            ledgers = None
-            self.logger.debug("begin offset\t%s\nlastoffset\t%s" % (offset, lastoffset))
+        self.sync_recent_ledgers(wm.Credit, rescan=rescan)
+
+    def sync_debits(self, rescan=False):
+        self.sync_recent_ledgers(wm.Debit, rescan=rescan)
+
+    @uses_session
+    def backfill(self, stream='trades', begin=None, end=None, window=BACKFILL_WINDOW):
+        """
+        Backfill a history stream ('trades', 'ledgers' or 'closed_orders') one time window at a time.
+
+        The range is split into windows aligned to multiples of window seconds, each fetched
+        with Kraken's start (exclusive) and end (inclusive) parameters, so offsets only shift
+        inside a window. Completed windows are remembered in Redis and skipped on the next
+        run, and a failed window is logged and left for the next run.
+
+        :return: a list of the (start, end) windows which failed
+        """
+        workers = self.get_backfill_workers(None)
+        pages, ingest, newest_of, indexed = {
+            'trades': (lambda b, e: self.iter_trade_pages(begin=b, tend=e, workers=workers),
+                       self.ingest_trades, newest_record, (em.Trade,)),
+            'ledgers': (lambda b, e: self.iter_ledger_pages(begin=b, tend=e, workers=workers),
+                        self.ingest_ledgers, newest_record, (wm.Credit, wm.Debit)),
+            'closed_orders': (lambda b, e: self.iter_pages(lambda ofs: self.get_closed_orders(begin=b, tend=e,
+                                                                                              offset=ofs),
+                                                           'closed', workers=workers),
+                              self.ingest_closed_orders, lambda rows, c: newest_cursor(rows, c, 'closetm'), ()),
+        }[stream]
+        now = int(time.time())
+        begin = int(begin) if begin is not None else KRAKEN_EPOCH
+        end = int(end) if end is not None else now
+        done_key = BACKFILL_KEY % (self.manager_user.id, stream)
+        newest = None
+        failed = []
+        self.get_writes().flush()  # a failed window's rollback must not discard other operations' writes
+        wstart = begin - begin % window
+        while wstart < end:
+            wend = wstart + window
+            wname = "%s:%s" % (wstart, wend)
+            if self.red.sismember(done_key, wname):
+                wstart = wend
+                continue
+            added = 0
             try:
-                ledgers = self.get_ledgers(ofs=offset, ltype='deposit')
-            except (IOError, ValueError) as e:
+                for rows in pages(wstart, wend):
+                    added += ingest(rows)
+                    newest = newest_of(rows, newest)
+            except Exception as e:
                 self.logger.exception(e)
-                if "ReadTimeout" in str(e):
-                    lastsleep *= 2
-                    time.sleep(lastsleep)
-                    continue
+                self.get_writes().rollback()
+                self.forget_known_ids()
+                failed.append((wstart, wend))
+            else:
+                if not self.get_writes().commit(now=True):
+                    self.forget_known_ids()
+                    failed.append((wstart, wend))
+                else:
+                    if added > 0:
+                        self.note_known_ids_committed(*indexed)
+                    self.logger.debug("backfilled %s %s in window %s" % (added, stream, wname))
+                    if wend <= now:
+                        self.red.sadd(done_key, wname)
+            wstart = wend
+        if len(failed) == 0 and newest is not None and self.get_cursor(stream) is None:
+            self.set_cursor(stream, newest)
+        return failed
+
+
+class KrakenFuture(object):
+    """
+    The pending result of a request sent by KrakenAsync.
+
+    If a then callback is given it is applied to the response by the thread which calls
+    get, so database sessions are only ever used by the thread that owns them.
+    """
+
+    def __init__(self, result, then=None):
+        self._result = result
+        self._then = then
+        self._done = False
+        self._value = None
+
+    def ready(self):
+        return self._result.ready()
+
+    def get(self, timeout=None):
+        if not self._done:
+            resp = self._result.get(timeout)
+            self._value = self._then(resp) if self._then is not None else resp
+            self._done = True
+        return self._value
+
+
+class KrakenAsync(object):
+    """
+    Non-blocking request layer for a Kraken plugin, so one process can keep many requests in flight.
+
+    Python 2 has no asyncio, so requests run on a pool of worker threads sharing the
+    plugin's keep-alive transport, rate limiter and nonce generator, and every call
+    returns a KrakenFuture. Private requests in flight together may reach Kraken out of
+    nonce order, so the API key should have a nonce window configured.
+    """
+
+    def __init__(self, kraken, workers=None):
+        self.kraken = kraken
+        if workers is None:
+            workers = kraken.get_config('async_workers', ASYNC_WORKERS, int)
+        self.pool = ThreadPool(workers)
+
+    def _request(self, method, params):
+        try:
+            return self.kraken.submit_private_request(method, params)
+        except Exception as e:
+            self.kraken.logger.exception(e)
+
+    def submit_private_request(self, method, params=None):
+        return KrakenFuture(self.pool.apply_async(self._request, (method, params)))
+
+    def submit_public_request(self, method, params=None):
+        return KrakenFuture(self.pool.apply_async(self.kraken.submit_public_request, (method, params)))
+
+    def get_order_book(self, market='BTC_USD'):
+        return KrakenFuture(self.pool.apply_async(self.kraken.get_order_book, (market,)))
+
+    def sync_ticker(self, market='BTC_USD'):
+        return KrakenFuture(self.pool.apply_async(self.kraken.sync_ticker, (market,)))
+
+    def create_order(self, oid):
+        """
+        Send the AddOrder for a pending order. The order is looked up and, once the
+        result is collected, updated on the calling thread.
+        """
+        with self.kraken.get_writes().lock:
+            order = self.kraken.session.query(em.LimitOrder).filter(em.LimitOrder.id == oid).first()
+            if not order:
+                self.kraken.logger.warning("unable to find order %s" % oid)
                 return
-            if not ledgers or 'result' not in ledgers or ledgers['result']['count'] == 0:
-                self.logger.warning(ledgers)
-                if "error" in ledgers and len(ledgers['error']) > 0 and \
-                                "Rate limit exceeded" in ledgers['error'][0]:
-                    lastsleep *= 1.5
-                    time.sleep(lastsleep)
-                    continue
-                elif "error" in ledgers and len(ledgers['error']) > 0 and \
-                                "Invalid nonce" in ledgers['error'][0]:
-                    time.sleep(30)
-                    continue
+            try:
+                options = self.kraken.order_options(order)
+            except ValueError as e:
+                self.kraken.logger.warning("kraken order %s is invalid: %s" % (oid, e))
                 return
-            if lastsleep > 1:
-                lastsleep *= 0.95
-            lastoffset = offset
-            for bid in ledgers['result']['ledger']:
-                row = ledgers['result']['ledger'][bid]
-                lastoffset = offset
-                if rescan:
-                    offset += 1
-                found = self.session.query(wm.Credit) \
-                    .filter(wm.Credit.ref_id == 'kraken|%s' % bid) \
-                    .count()
-                if found != 0:
-                    self.logger.debug("%s already known" % bid)
-                    continue
-                dtime = datetime.datetime.fromtimestamp(float(row['time']))
-                asset = self.format_commodity(row['asset'])
-                amount = Amount("%s %s" % (row['amount'], asset))
-                refid = row['refid']
-                cred = wm.Credit(amount, refid, asset, "kraken", "complete", "kraken", "kraken|%s" % bid,
-                                 self.manager_user.id, dtime)
-                self.session.add(cred)
-                changed = True
-                self.logger.debug("end offset\t%s\nlastoffset\t%s" % (offset, lastoffset))
-        if changed:
-            self.session.commit()
+        return KrakenFuture(self.pool.apply_async(self._request, ('AddOrder', options)),
+                            lambda resp: self.kraken.apply_add_order(order, options, resp))
 
-    def sync_debits(self, rescan=False):
-        offset = 0
-        lastoffset = -1
-        lastsleep = 2
-        ledgers = None
-        changed = True
-        while offset != lastoffset:
-            try:
-                ledgers = self.get_ledgers(ofs=offset, ltype='withdrawal')
-            except (IOError, ValueError) as e:
-                if "ReadTimeout" in str(e):
-                    lastsleep *= 2
-                    time.sleep(lastsleep)
-                    continue
-            if not ledgers or 'result' not in ledgers or ledgers['result']['count'] == 0:
-                self.logger.debug("; non-interesting ledgers %s" % ledgers)
-                if "error" in ledgers and len(ledgers['error']) > 0 and \
-                        "Rate limit exceeded" in ledgers['error'][0]:
-                    lastsleep *= 2
-                    time.sleep(lastsleep)
-                elif "error" in ledgers and len(ledgers['error']) > 0 and \
-                        "Invalid nonce" in ledgers['error'][0]:
-                    time.sleep(30)
-                continue
-            if lastsleep > 1:
-                lastsleep -= 1
-            lastoffset = offset
-            for bid in ledgers['result']['ledger']:
-                lastoffset = offset
-                if rescan:
-                    offset += 1
-                found = self.session.query(wm.Debit) \
-                    .filter(wm.Debit.ref_id == 'kraken|%s' % bid) \
-                    .count()
-                if found != 0:
-                    self.logger.debug("; %s already known" % bid)
-                    continue
-                row = ledgers['result']['ledger'][bid]
-                dtime = datetime.datetime.fromtimestamp(float(row['time']))
-                asset = self.format_commodity(row['asset'])
-                amount = Amount("%s %s" % (row['amount'], asset))
-                fee = Amount("%s %s" % (row['fee'], asset))
-                refid = row['refid']
-                self.session.add(wm.Debit(amount, fee, refid, asset, "kraken", "complete", "kraken", "kraken|%s" % bid,
-                                          self.manager_user.id, dtime))
-                changed = True
-                self.logger.debug("end offset\t%s\nlastoffset\t%s" % (offset, lastoffset))
-        if changed:
-            self.session.commit()
+    def cancel_order(self, order):
+        return KrakenFuture(self.pool.apply_async(self._request,
+                                                  ('CancelOrder', {'txid': order.order_id.split("|")[1]})),
+                            lambda resp: self.kraken.apply_cancel_order(order, resp))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
 
 
 def main():
@@ -23,6 +23,11 @@ setup(
         'tapp-config>=0.0.2',
         'tappmq', 'requests',
     ],
+    extras_require={
+        'analytics': ['numpy'],
+        'stream': ['websocket-client'],
+        'fastjson': ['ujson'],
+    },
     tests_require=['pytest', 'pytest-cov'],
     entry_points="""
 [console_scripts]
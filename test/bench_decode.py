@@ -0,0 +1,68 @@
+"""
+Micro-benchmark of Kraken response decoding: the old text decode, json.loads and substring
+scans against decode_response and has_error on the raw bytes.
+
+Run with `python test/bench_decode.py [path to a recorded response ...]`. Without arguments
+it uses generated TradesHistory and Depth pages the size of Kraken's largest.
+"""
+import json
+import random
+import sys
+import timeit
+
+import kraken_manager
+from kraken_manager import decode_response, has_error
+
+ROUNDS = 50
+
+
+def trades_page(rows=50):
+    trades = {}
+    for i in range(rows):
+        trades['T%05d-ABCDE-FGHIJK' % i] = {
+            'ordertxid': 'O%05d-ABCDE-FGHIJK' % i, 'postxid': 'P%05d-ABCDE-FGHIJK' % i,
+            'pair': 'XXBTZUSD', 'time': 1500000000 + i * 37.1234, 'type': random.choice(['buy', 'sell']),
+            'ordertype': 'limit', 'price': '%.5f' % random.uniform(300, 500), 'cost': '%.5f' % random.uniform(1, 900),
+            'fee': '%.5f' % random.uniform(0, 2), 'vol': '%.8f' % random.uniform(0, 3), 'margin': '0.00000',
+            'misc': ''}
+    return json.dumps({'error': [], 'result': {'trades': trades, 'count': 100000}})
+
+
+def depth_page(levels=500):
+    def side(low, high):
+        return [['%.5f' % random.uniform(low, high), '%.8f' % random.uniform(0, 10), 1500000000 + i]
+                for i in range(levels)]
+    return json.dumps({'error': [], 'result': {'XXBTZUSD': {'asks': side(400, 500), 'bids': side(300, 400)}}})
+
+
+def old_decode(raw):
+    response = raw.decode('utf-8')
+    resp = json.loads(response)
+    return resp, "Invalid nonce" in response or "Rate limit exceeded" in response
+
+
+def new_decode(raw):
+    resp = decode_response(raw)
+    return resp, has_error(resp, "Invalid nonce") or has_error(resp, "Rate limit exceeded")
+
+
+def bench(name, raw):
+    old = min(timeit.repeat(lambda: old_decode(raw), number=ROUNDS, repeat=3)) / ROUNDS
+    new = min(timeit.repeat(lambda: new_decode(raw), number=ROUNDS, repeat=3)) / ROUNDS
+    print("%-20s %8d bytes  old %8.3fms  new %8.3fms  %.2fx" % (name, len(raw), old * 1000, new * 1000, old / new))
+
+
+def main():
+    backend = kraken_manager.fastjson.__name__ if kraken_manager.fastjson is not None else 'json'
+    print("decoding with %s" % backend)
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                bench(path, f.read())
+    else:
+        bench('TradesHistory', trades_page())
+        bench('Depth', depth_page())
+
+
+if __name__ == "__main__":
+    main()
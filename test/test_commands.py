@@ -1,12 +1,23 @@
+import binascii
 import json
 import os
+import tempfile
+import threading
 import time
 import unittest
+import urlparse
+import pytest
+from decimal import Decimal
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 from ledger import Amount
 from ledger import Balance
+from requests.exceptions import ReadTimeout
 
 from jsonschema import validate
-from kraken_manager import Kraken
+from kraken_manager import BloomFilter, DepthBook, ExchangeMetadata, Kraken, KrakenAsync, KrakenTransport, NonceGenerator, OrderBook, RateLimiter, \
+    KnownIds, LedgerRecord, OrderRecord, SymbolTable, TradeRecord, WriteBehind, decimal_amount, decode_response, has_error, \
+    BACKFILL_KEY, CURSOR_KEY, KNOWN_IDS_KEY, LEDGER_SYNC_REUSE, newest_cursor, newest_record
 
 from sqlalchemy_models import get_schemas, wallet as wm, exchange as em
 
@@ -40,6 +51,719 @@ def test_markets():
         assert kraken.format_market(map[good]) == good
 
 
+def test_symbol_table():
+    assets = {'XXBT': {'altname': 'XBT'}, 'ZUSD': {'altname': 'USD'}, 'DASH': {'altname': 'DASH'}}
+    pairs = {'XXBTZUSD': {'altname': 'XBTUSD', 'wsname': 'XBT/USD', 'base': 'XXBT', 'quote': 'ZUSD'},
+             'XXBTZUSD.d': {'altname': 'XBTUSD.d', 'base': 'XXBT', 'quote': 'ZUSD'},
+             'DASHXBT': {'altname': 'DASHXBT', 'wsname': 'DASH/XBT', 'base': 'DASH', 'quote': 'XXBT'}}
+    symbols = SymbolTable(assets, pairs)
+    for alias in ('XXBTZUSD', 'XBTUSD', 'XBT/USD', 'BTC_USD'):
+        assert symbols.markets[alias] == 'BTC_USD'
+    # the 4+4 heuristic splits this 7 letter pair in the wrong place
+    assert symbols.markets['DASHXBT'] == 'DASH_BTC'
+    assert symbols.pairs['DASH_BTC'] == 'DASHXBT'
+    assert symbols.wsnames['BTC_USD'] == 'XBT/USD'
+    assert symbols.commodities['XXBT'] == 'BTC'
+    assert symbols.assets['USD'] == 'ZUSD'
+
+
+def test_metadata_round_order():
+    pairs = {'XXBTZUSD': {'altname': 'XBTUSD', 'base': 'XXBT', 'quote': 'ZUSD',
+                          'pair_decimals': 1, 'lot_decimals': 8, 'ordermin': '0.0001'}}
+    metadata = ExchangeMetadata({'XXBT': {'altname': 'XBT'}, 'ZUSD': {'altname': 'USD'}}, pairs)
+    assert metadata.round_order('XXBTZUSD', 'buy', '100.19', '0.123456789') == ('100.1', '0.12345678')
+    assert metadata.round_order('XXBTZUSD', 'sell', '100.11', '0.01') == ('100.2', '0.01000000')
+    with pytest.raises(ValueError):
+        metadata.round_order('XXBTZUSD', 'buy', '100', '0.00001')
+    path = os.path.join(tempfile.mkdtemp(), 'metadata.json')
+    metadata.save(path)
+    cached = ExchangeMetadata.load(path)
+    assert not cached.is_stale()
+    assert cached.symbols.pairs['BTC_USD'] == 'XXBTZUSD'
+
+
+def test_stale_metadata(monkeypatch):
+    pairs = {'XXBTZUSD': {'altname': 'XBTUSD', 'base': 'XXBT', 'quote': 'ZUSD', 'pair_decimals': 1, 'lot_decimals': 8}}
+    path = os.path.join(tempfile.mkdtemp(), 'metadata.json')
+    ExchangeMetadata({'XXBT': {'altname': 'XBT'}, 'ZUSD': {'altname': 'USD'}}, pairs, fetched=0).save(path)
+    monkeypatch.setattr(kraken, 'get_config', lambda option, default=None, cast=None:
+                        path if option == 'metadata_file' else default)
+    monkeypatch.setattr(kraken, 'refresh_metadata', lambda: None)
+    for name in ('_metadata', '_symbols', '_markets', '_commodities'):
+        monkeypatch.setattr(Kraken, name, None)
+    # the refresh failed, so the stale cache is used rather than nothing
+    metadata = kraken.load_metadata()
+    assert metadata.is_stale() and Kraken._metadata is metadata
+    assert Kraken._symbols.pairs['BTC_USD'] == 'XXBTZUSD'
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(tier='starter', reserve=3)
+    assert limiter.acquire('AddOrder') == 0
+    assert limiter.remaining() > 14.9
+    for i in range(6):
+        assert limiter.acquire('TradesHistory') == 0
+    # history calls must leave the reserve free, order management may use it
+    assert limiter.remaining() < 3 + RateLimiter.cost('TradesHistory')
+    assert limiter.acquire('OpenOrders') == 0
+    limiter.penalize()
+    assert limiter.remaining() < 1
+
+
+def test_nonce_file_backend():
+    path = os.path.join(tempfile.mkdtemp(), 'nonce')
+    first = NonceGenerator(path=path)
+    nonces = [first.next() for i in range(100)]
+    assert nonces == sorted(set(nonces))
+    # a second process sharing the key, with its clock stepped back, still moves forward
+    with open(path, 'w') as f:
+        f.write(str(nonces[-1] + 10 ** 6))
+    assert NonceGenerator(path=path).next() == nonces[-1] + 10 ** 6 + 1
+
+
+class FailingRedis(object):
+    def register_script(self, script):
+        raise IOError("connection refused")
+
+
+def test_nonce_redis_failure():
+    path = os.path.join(tempfile.mkdtemp(), 'nonce')
+    nonces = NonceGenerator(red=FailingRedis(), path=path)
+    # a redis failure must not hand out a nonce from the file, which other processes can not see
+    with pytest.raises(IOError):
+        nonces.next()
+    assert not os.path.exists(path)
+
+
+class CountingSession(object):
+    commits = 0
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_write_behind():
+    session = CountingSession()
+    writes = WriteBehind(session, kraken.logger, max_ops=3, max_delay=60)
+    assert writes.commit() and writes.commit()
+    assert session.commits == 0
+    writes.commit()
+    assert session.commits == 1 and writes.stats()['last_size'] == 3
+    writes.commit(now=True)
+    assert session.commits == 2 and writes.stats()['batches'] == 2
+    assert writes.flush() and session.commits == 2
+    writes.commit()
+    assert writes.flush_overdue() and session.commits == 2
+    # a batch older than max_delay is committed by the next check, on the calling thread
+    writes.oldest -= 61
+    assert writes.flush_overdue() and session.commits == 3
+
+
+def test_decode_records():
+    markets = lambda pair: {'XXBTZUSD': ('BTC_USD', 'BTC', 'USD')}[pair]
+    trade = TradeRecord.decode('TA', {'pair': 'XXBTZUSD', 'type': 'buy', 'price': '420.5', 'vol': '0.00000001',
+                                      'fee': '0.01', 'time': 1500000001.5}, markets)
+    assert trade.market == 'BTC_USD' and trade.vol == Decimal('0.00000001')
+    assert str(decimal_amount(trade.vol, 'BTC')) == str(Amount("0.00000001 BTC"))
+    order = OrderRecord.decode('OA', {'descr': {'pair': 'XXBTZUSD', 'type': 'sell', 'price': '500'},
+                                      'vol': '1.5', 'vol_exec': '0.5'}, markets)
+    assert order.side == 'ask' and order.remaining() == Decimal('1.0') and order.avg_price == 0
+    entry = LedgerRecord.decode('LA', {'refid': 'R', 'type': 'deposit', 'asset': 'XXBT', 'amount': '2',
+                                       'fee': '0', 'time': '1500000001'}, lambda asset: 'BTC')
+    assert entry.asset == 'BTC' and entry.amount == 2
+    with pytest.raises(AttributeError):
+        entry.extra = 1
+
+
+def test_decode_response():
+    resp = decode_response(b'{"error": ["EAPI:Invalid nonce"], "result": {}}')
+    assert has_error(resp, "Invalid nonce") and not has_error(resp, "Rate limit exceeded")
+    # only the error list counts, not text elsewhere in the response
+    assert not has_error(decode_response(b'{"error": [], "result": {"misc": "Invalid nonce"}}'), "Invalid nonce")
+    with pytest.raises(ValueError):
+        decode_response(b'<html>')
+
+
+def test_reserved_balance():
+    rawos = {'OA': {'descr': {'pair': 'XXBTZUSD', 'type': 'sell', 'price': '500'},
+                    'vol': '0.50000000', 'vol_exec': '0.49999990'},
+             'OB': {'descr': {'pair': 'XXBTZUSD', 'type': 'buy', 'price': '400'},
+                    'vol': '0.5', 'vol_exec': '0'}}
+    # the remaining 1.0E-7 BTC must reach Amount in plain decimal form
+    held = kraken.reserved_balance(rawos)
+    assert held.commodity_amount(Amount("0 BTC").commodity) == Amount("0.0000001 BTC")
+    assert held.commodity_amount(Amount("0 USD").commodity) == Amount("200 USD")
+
+
+def test_known_ids():
+    bloom = BloomFilter(1000)
+    for i in range(1000):
+        bloom.add('kraken|T%s' % i)
+    assert all('kraken|T%s' % i in bloom for i in range(1000))
+    assert sum('kraken|X%s' % i in bloom for i in range(10000)) < 100
+    index = KnownIds(3, max_ids=2)
+    for ref in ['kraken|A', 'kraken|B', 'kraken|C']:
+        index.add(ref)
+    # past max_ids only the Bloom filter remembers, so C has to be settled by the database
+    assert index.split(['kraken|A', 'kraken|B', 'kraken|C', 'kraken|D']) == (set(['kraken|A', 'kraken|B']),
+                                                                               ['kraken|C'])
+    index.behind = True
+    assert index.split(['kraken|A', 'kraken|C', 'kraken|D']) == (set(['kraken|A']), ['kraken|C', 'kraken|D'])
+
+
+def test_known_ids_outside_commits():
+    index = kraken.get_known_ids(em.Trade, em.Trade.trade_id)
+    assert kraken.get_known_ids(em.Trade, em.Trade.trade_id) is index
+    # this process' own commits are already in its index
+    kraken.note_known_ids_committed(em.Trade)
+    assert kraken.get_known_ids(em.Trade, em.Trade.trade_id) is index
+    assert not index.behind
+    # another process committed trades, so misses are asked of the database instead of rescanning it
+    kraken.red.incr(KNOWN_IDS_KEY % 'Trade')
+    assert kraken.get_known_ids(em.Trade, em.Trade.trade_id) is index and index.behind
+    assert index.split(['kraken|unseen']) == (set(), ['kraken|unseen'])
+
+
+def test_newest_cursor():
+    rows = {'TA': {'time': 1500000001.5}, 'TB': {'time': 1500000003.25}, 'TC': {'time': 1500000002}}
+    cursor = newest_cursor(rows)
+    assert cursor == {'time': 1500000003.25, 'id': 'TB'}
+    assert newest_cursor({'TD': {'time': 1400000000}}, cursor) is cursor
+    markets = lambda pair: ('BTC_USD', 'BTC', 'USD')
+    records = [TradeRecord.decode(tid, dict(row, pair='XXBTZUSD', type='buy', price='1', vol='1', fee='0'), markets)
+               for tid, row in rows.items()]
+    assert newest_record(records) == cursor
+
+
+def test_order_book():
+    book = OrderBook('BTC_USD', depth=3)
+    book.load_snapshot([['101.00000', '1.000', '1'], ['102.00000', '2.000', '1'], ['103.00000', '3.000', '1']],
+                       [['100.00000', '1.500', '1'], ['99.00000', '2.500', '1']])
+    book.apply_levels(asks=[['100.50000', '0.500', '2'], ['102.00000', '0.00000000', '2']],
+                      bids=[['99.00000', '4.000', '2']])
+    # inserting 100.5 pushed 103 out of the 3 level book before 102 was removed
+    assert book.asks.levels() == [('100.50000', '0.500'), ('101.00000', '1.000')]
+    assert book.bids.levels() == [('100.00000', '1.500'), ('99.00000', '4.000')]
+    book.apply_levels(asks=[['100.25000', '1.000', '3']])
+    assert book.asks.levels(1) == [('100.25000', '1.000')]
+    expected = '100250001000' + '10050000500' + '101000001000' + '100000001500' + '99000004000'
+    assert book.checksum() == binascii.crc32(expected) & 0xffffffff
+
+
+def book_checksum(asks, bids):
+    """Kraken's book checksum, over the levels best first as the websocket feed writes them."""
+    parts = [s.replace('.', '').lstrip('0') for price, volume in asks + bids for s in (price, volume)]
+    return str(binascii.crc32(''.join(parts)) & 0xffffffff)
+
+
+def test_book_messages(monkeypatch):
+    monkeypatch.setattr(kraken, '_books', {})
+    monkeypatch.setattr(kraken, 'publish_book', lambda book: None)
+    rest = {'asks': [['5541.3', '2.507', 1534614248], ['5542.5', '0.438', 1534614248]],
+            'bids': [['5541.2', '1.529', 1534614248], ['5539.9', '0.3', 1534614248]]}
+    monkeypatch.setattr(kraken, 'get_order_book', lambda market, count=None: rest)
+    snapshot = [0, {'as': [['5541.30000', '2.50700000', '1534614248.123678'],
+                           ['5542.50000', '0.40100000', '1534614248.456738']],
+                    'bs': [['5541.20000', '1.52900000', '1534614248.765567'],
+                           ['5539.90000', '0.30000000', '1534614241.769870']]}, 'book-10', 'XBT/USD']
+    book = kraken.apply_book_message(snapshot)
+    update = [0, {'a': [['5542.50000', '0.43800000', '1534614248.5']],
+                  'c': book_checksum([('5541.30000', '2.50700000'), ('5542.50000', '0.43800000')],
+                                     [('5541.20000', '1.52900000'), ('5539.90000', '0.30000000')])},
+              'book-10', 'XBT/USD']
+    assert kraken.apply_book_message(update).asks.levels() == [('5541.30000', '2.50700000'),
+                                                               ('5542.50000', '0.43800000')]
+    # a wrong checksum reloads from Depth, whose strings are rewritten to the feed's decimals
+    kraken.apply_book_message([0, dict(update[1], c='1'), 'book-10', 'XBT/USD'])
+    assert book.asks.levels(1) == [('5541.30000', '2.50700000')]
+    assert book.bids.levels() == [('5541.20000', '1.52900000'), ('5539.90000', '0.30000000')]
+    # so the next update's checksum matches the reloaded book, and it is not reloaded again
+    monkeypatch.setattr(kraken, 'sync_book', lambda market: pytest.fail("book reloaded again"))
+    assert kraken.apply_book_message(update) is book
+
+
+def test_depth_book():
+    np = pytest.importorskip('numpy')
+    book = DepthBook('BTC_USD', [['101.0', '1.0', 1], ['102.0', '2.0', 1]], [['100.0', '1.0', 1], ['99.0', '3.0', 1]])
+    assert book.mid() == 100.5
+    assert book.spread() == 1
+    costs = book.cost_to_fill([0.5, 1, 3, 4], side='bid')
+    assert list(costs[:3]) == [50.5, 101, 305]
+    assert np.isnan(costs[3])
+    assert list(book.vwap([2], side='ask')) == [99.5]
+    assert list(book.slippage_bps([2], side='ask')) == [50]
+    bids, asks = book.depth_within([60, 150])
+    assert list(bids) == [1, 4]
+    assert list(asks) == [1, 3]
+
+
+class StubKrakenServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubKrakenHandler(BaseHTTPRequestHandler):
+    """Answer public Depth requests with a one level book for the requested pair."""
+    def do_GET(self):
+        pair = urlparse.parse_qs(urlparse.urlparse(self.path).query)['pair'][0]
+        body = json.dumps({'error': [], 'result': {pair: {'asks': [['101.0', '1.0', 1]],
+                                                          'bids': [['100.0', '2.0', 1]]}}})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_async_order_books():
+    server = StubKrakenServer(('127.0.0.1', 0), StubKrakenHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    transport = Kraken._transport
+    Kraken._transport = KrakenTransport(base_url='http://127.0.0.1:%s' % server.server_address[1])
+    client = KrakenAsync(kraken, workers=4)
+    try:
+        futures = [client.get_order_book(m) for m in ('BTC_USD', 'ETH_BTC', 'LTC_BTC')]
+        books = [f.get(timeout=10) for f in futures]
+    finally:
+        client.close()
+        server.shutdown()
+        Kraken._transport = transport
+    assert len(books) == 3
+    for book in books:
+        assert book['bids'][0][0] == '100.0'
+        assert book['asks'][0][0] == '101.0'
+
+
+class StubPrivate(object):
+    """Answer private requests with canned responses by method, or functions of the params, recording each call."""
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = []
+
+    def __call__(self, method, params=None, retry=0):
+        self.calls.append((method, params))
+        resp = self.responses.get(method)
+        return resp(params) if callable(resp) else resp
+
+    def methods(self):
+        return [method for method, params in self.calls]
+
+
+def stub_private(monkeypatch, responses):
+    stub = StubPrivate(responses)
+    monkeypatch.setattr(kraken, 'submit_private_request', stub)
+    monkeypatch.setattr(kraken, '_open_orders', None)
+    return stub
+
+
+def raw_order(side, price, vol='1', vol_exec='0', userref=None):
+    return {'descr': {'pair': 'XXBTZUSD', 'type': 'sell' if side == 'ask' else 'buy', 'price': price},
+            'vol': vol, 'vol_exec': vol_exec, 'userref': userref}
+
+
+def pending_batch(*ids):
+    batch = []
+    for oid in ids:
+        order = em.LimitOrder(Amount("500 USD"), Amount("1 BTC"), 'BTC_USD', 'ask', 'kraken')
+        order.id = oid
+        batch.append((order, {'type': 'sell', 'volume': '1', 'price': '500', 'pair': 'XXBTZUSD',
+                              'ordertype': 'limit', 'userref': oid}))
+    return batch
+
+
+class StubResponse(object):
+    def __init__(self, body, status_code=200):
+        self.content = json.dumps(body)
+        self.status_code = status_code
+
+
+class StubTransport(object):
+    """Answer private POSTs with canned replies in turn, the last one repeating; exceptions are raised."""
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.posts = []
+
+    def post(self, path, method, data=None, headers=None):
+        self.posts.append(method)
+        reply = self.replies.pop(0) if len(self.replies) > 1 else self.replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def stub_transport(monkeypatch, *replies):
+    transport = StubTransport(*replies)
+    monkeypatch.setattr(Kraken, '_transport', transport)
+    monkeypatch.setattr(kraken, '_rate_limiter', RateLimiter())
+    return transport
+
+
+def test_order_engine_rate_limit(monkeypatch):
+    transport = stub_transport(monkeypatch, StubResponse({'error': ['EOrder:Rate limit exceeded']}))
+    resp = kraken.submit_private_request('AddOrder', {'pair': 'XXBTZUSD', 'type': 'buy', 'volume': '1'})
+    # the matching engine's limit is the caller's to handle, and leaves the API counter alone
+    assert resp['error'] == ['EOrder:Rate limit exceeded']
+    assert transport.posts == ['AddOrder']
+    assert kraken.get_rate_limiter().remaining() > 14.9
+
+
+def test_api_rate_limit(monkeypatch):
+    transport = stub_transport(monkeypatch, StubResponse({'error': ['EAPI:Rate limit exceeded']}),
+                               StubResponse({'error': [], 'result': {'open': {}}}))
+    monkeypatch.setattr(RateLimiter, 'acquire', lambda self, method: 0)
+    resp = kraken.submit_private_request('OpenOrders')
+    assert resp['result'] == {'open': {}}
+    assert transport.posts == ['OpenOrders', 'OpenOrders']
+    assert kraken.get_rate_limiter().remaining() < 1
+
+
+def test_order_batch_timeout(monkeypatch):
+    batch = pending_batch(1011, 1012)
+    transport = stub_transport(monkeypatch, ReadTimeout('read timed out'),
+                               StubResponse({'error': [], 'result': {'open': {
+                                   'OT': raw_order('ask', '500', userref=1011)}}}),
+                               StubResponse({'error': [], 'result': {'closed': {}}}))
+    monkeypatch.setattr(kraken, '_open_orders', None)
+    opened = kraken.submit_order_batch('XXBTZUSD', batch)
+    # the batch may have been placed before the reply was lost, so it is looked up, never resent
+    assert transport.posts == ['AddOrderBatch', 'OpenOrders', 'ClosedOrders']
+    assert opened == [batch[0][0]] and batch[0][0].order_id == 'kraken|OT'
+    assert batch[1][0].state == 'pending'
+
+
+def test_resend_after_timeout(monkeypatch):
+    transport = stub_transport(monkeypatch, StubResponse({'error': []}, status_code=502),
+                               StubResponse({'error': [], 'result': {'open': {}}}))
+    assert kraken.submit_private_request('AddOrder', {'pair': 'XXBTZUSD'}) is None
+    assert transport.posts == ['AddOrder']
+    # requests which can not place orders are sent again
+    transport = stub_transport(monkeypatch, ReadTimeout('read timed out'),
+                               StubResponse({'error': [], 'result': {'open': {}}}))
+    assert kraken.submit_private_request('OpenOrders')['result'] == {'open': {}}
+    assert transport.posts == ['OpenOrders', 'OpenOrders']
+
+
+def test_order_batch_txids(monkeypatch):
+    batch = pending_batch(1001, 1002, 1003)
+    stub = stub_private(monkeypatch, {'AddOrderBatch': {'error': [], 'result': {'orders': [
+        {'txid': 'OA'}, {'error': 'EOrder:Insufficient funds'}, {'txid': 'OC'}]}}})
+    opened = kraken.submit_order_batch('XXBTZUSD', batch)
+    assert opened == [batch[0][0], batch[2][0]]
+    assert [o.order_id for o, options in batch][0::2] == ['kraken|OA', 'kraken|OC']
+    # the failed order stays pending and is not resent on its own
+    assert batch[1][0].state == 'pending' and batch[1][0].order_id.startswith('tmp|')
+    assert stub.methods() == ['AddOrderBatch']
+
+
+def test_order_batch_rejected(monkeypatch):
+    batch = pending_batch(1001, 1002)
+    stub = stub_private(monkeypatch, {
+        'AddOrderBatch': {'error': ['EGeneral:Invalid arguments']},
+        'AddOrder': lambda params: {'error': [], 'result': {'txid': ['S%s' % params['userref']]}}})
+    opened = kraken.submit_order_batch('XXBTZUSD', batch)
+    assert [o.order_id for o in opened] == ['kraken|S1001', 'kraken|S1002']
+    assert stub.methods() == ['AddOrderBatch', 'AddOrder', 'AddOrder']
+
+
+def test_order_batch_unknown_outcome(monkeypatch):
+    batch = pending_batch(1001, 1002, 1003)
+    stub = stub_private(monkeypatch, {
+        'AddOrderBatch': None,
+        'OpenOrders': {'error': [], 'result': {'open': {'OX': raw_order('ask', '500', userref=1001)}}},
+        'ClosedOrders': {'error': [], 'result': {'closed': {'OY': raw_order('ask', '500', userref=1002)}}}})
+    opened = kraken.submit_order_batch('XXBTZUSD', batch)
+    # Kraken may have taken the batch, so nothing is resent; orders are found by userref instead
+    assert 'AddOrder' not in stub.methods()
+    assert opened == [batch[0][0]] and batch[0][0].order_id == 'kraken|OX'
+    assert batch[1][0].order_id == 'kraken|OY' and batch[1][0].state == 'closed'
+    assert batch[2][0].state == 'pending'
+
+
+def local_order(order_id, side='ask', state='open'):
+    order = em.LimitOrder(Amount("500 USD"), Amount("1 BTC"), 'BTC_USD', side, 'kraken', order_id=order_id,
+                          exec_amount=Amount("0 BTC"), state=state)
+    kraken.session.add(order)
+    kraken.session.commit()
+    return order
+
+
+def delete_orders(*order_ids):
+    kraken.get_writes().flush()
+    for order in kraken.session.query(em.LimitOrder).filter(em.LimitOrder.order_id.in_(order_ids)):
+        kraken.session.delete(order)
+    kraken.session.commit()
+
+
+def test_get_open_orders_reconcile(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    stale = local_order('kraken|OS%s' % suffix)
+    kept = local_order('kraken|OK%s' % suffix)
+    stub = stub_private(monkeypatch, {'OpenOrders': {'error': [], 'result': {'open': {
+        'OK%s' % suffix: raw_order('ask', '500'),
+        'ON%s' % suffix: raw_order('bid', '400', vol='2', vol_exec='0.5')}}}})
+    try:
+        orders = dict((o.order_id, o) for o in kraken.get_open_orders())
+        assert stub.methods() == ['OpenOrders']
+        # gone from Kraken's open set, so closed locally; still open, so kept
+        assert stale.state == 'closed' and kept.state == 'open'
+        new = orders['kraken|ON%s' % suffix]
+        assert new.side == 'bid' and new.state == 'open' and new.amount == Amount("1.5 BTC")
+        assert set(orders) == set(['kraken|OK%s' % suffix, 'kraken|ON%s' % suffix])
+    finally:
+        delete_orders(*['kraken|O%s%s' % (c, suffix) for c in 'SKN'])
+
+
+def test_open_orders_snapshot(monkeypatch):
+    stub = stub_private(monkeypatch, {'OpenOrders': {'error': [], 'result': {'open': {'OA': raw_order('ask', '500')}}}})
+    first = kraken.fetch_open_orders(max_age=60)
+    assert kraken.fetch_open_orders(max_age=60) == first == {'OA': raw_order('ask', '500')}
+    assert stub.methods() == ['OpenOrders']
+    # placements and cancellations are applied to the snapshot without another request
+    kraken.patch_open_orders(added={'OB': raw_order('bid', '400')}, removed=['OA'])
+    assert kraken.fetch_open_orders(max_age=60).keys() == ['OB']
+    assert stub.methods() == ['OpenOrders']
+    assert kraken.fetch_open_orders(max_age=-1).keys() == ['OA']
+    kraken.invalidate_open_orders()
+    kraken.fetch_open_orders(max_age=60)
+    assert stub.methods() == ['OpenOrders'] * 3
+    stub.responses['OpenOrders'] = None
+    assert kraken.fetch_open_orders(max_age=-1) is None
+    # a failed fetch drops the snapshot rather than serving it past its age
+    stub.responses['OpenOrders'] = {'error': [], 'result': {'open': {}}}
+    assert kraken.fetch_open_orders(max_age=60) == {}
+
+
+def test_ingest_closed_orders():
+    suffix = binascii.hexlify(os.urandom(4))
+    known = local_order('kraken|CK%s' % suffix)
+    rawos = {'CK%s' % suffix: dict(raw_order('ask', '500', vol='1', vol_exec='0.25'), price='501'),
+             'CN%s' % suffix: dict(raw_order('bid', '400', vol='2', vol_exec='2'), price='399.5')}
+    try:
+        assert kraken.ingest_closed_orders(rawos) == 1
+        # known orders are closed with their final exec amount, not added again
+        assert known.state == 'closed' and known.exec_amount == Amount("0.25 BTC")
+        new = kraken.session.query(em.LimitOrder).filter(em.LimitOrder.order_id == 'kraken|CN%s' % suffix).one()
+        assert new.state == 'closed' and new.side == 'bid'
+        assert new.price == Amount("399.5 USD") and new.exec_amount == Amount("2 BTC")
+    finally:
+        delete_orders('kraken|CK%s' % suffix, 'kraken|CN%s' % suffix)
+
+
+def test_cancel_orders(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    ask, bid = 'XA%s' % suffix, 'XB%s' % suffix
+    stub = stub_private(monkeypatch, {
+        'OpenOrders': {'error': [], 'result': {'open': {ask: raw_order('ask', '500'), bid: raw_order('bid', '400')}}},
+        'CancelOrderBatch': lambda params: {'error': [], 'result': {'count': len(params['orders'])}},
+        'CancelAll': {'error': [], 'result': {'count': 1}}})
+    monkeypatch.setattr(kraken, 'get_config', lambda option, default=None, cast=None:
+                        60 if option == 'open_orders_ttl' else default)
+    try:
+        # a filter cancels only the matching orders, in one batch
+        kraken.cancel_orders(side='ask')
+        assert stub.calls[-1] == ('CancelOrderBatch', {'orders': [ask]})
+        orders = dict((o.order_id, o) for o in kraken.get_open_orders())
+        assert orders.keys() == ['kraken|%s' % bid]
+        # no filter cancels everything with CancelAll, from the patched snapshot
+        kraken.cancel_orders()
+        assert stub.methods() == ['OpenOrders', 'CancelOrderBatch', 'CancelAll']
+        assert orders['kraken|%s' % bid].state == 'closed'
+    finally:
+        delete_orders('kraken|%s' % ask, 'kraken|%s' % bid)
+
+
+def test_cancel_orders_partial(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    ask = 'XA%s' % suffix
+    stub = stub_private(monkeypatch, {
+        'OpenOrders': {'error': [], 'result': {'open': {ask: raw_order('ask', '500')}}},
+        'CancelOrderBatch': {'error': [], 'result': {'count': 0}}})
+    try:
+        kraken.cancel_orders(side='ask')
+        # Kraken cancelled fewer orders than asked, so the local orders follow OpenOrders instead
+        assert stub.methods() == ['OpenOrders', 'CancelOrderBatch', 'OpenOrders']
+        order = kraken.session.query(em.LimitOrder).filter(em.LimitOrder.order_id == 'kraken|%s' % ask).one()
+        assert order.state == 'open'
+    finally:
+        delete_orders('kraken|%s' % ask)
+
+
+def history_page(key, rows, count=None):
+    return {'error': [], 'result': {key: rows, 'count': len(rows) if count is None else count}}
+
+
+def raw_trade(side, price, vol, rtime):
+    return {'pair': 'XXBTZUSD', 'type': 'sell' if side == 'ask' else 'buy', 'ordertype': 'limit',
+            'price': price, 'vol': vol, 'fee': '0.01', 'cost': '1', 'time': rtime}
+
+
+def raw_ledger(ltype, asset, amount, rtime):
+    return {'refid': 'R%s' % rtime, 'type': ltype, 'asset': asset, 'amount': amount, 'fee': '0.0', 'time': rtime,
+            'balance': '1'}
+
+
+def clear_cursor(stream):
+    key = CURSOR_KEY % (kraken.manager_user.id, stream)
+    saved = kraken.red.get(key)
+    kraken.red.delete(key)
+    return key, saved
+
+
+def restore_cursor(key, saved):
+    if saved:
+        kraken.red.set(key, saved)
+    else:
+        kraken.red.delete(key)
+
+
+def stored_trades(*trade_ids):
+    kraken.get_writes().flush()
+    return kraken.session.query(em.Trade).filter(em.Trade.trade_id.in_(['kraken|%s' % t for t in trade_ids])).all()
+
+
+def delete_rows(model, column, *refs):
+    kraken.get_writes().flush()
+    for row in kraken.session.query(model).filter(column.in_(refs)):
+        kraken.session.delete(row)
+    kraken.session.commit()
+    kraken.forget_known_ids(model)
+
+
+def test_sync_trades_cursor(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    old, new = 'TO%s' % suffix, 'TN%s' % suffix
+    page = {old: raw_trade('bid', '400', '1', 1500000000.25), new: raw_trade('ask', '401', '0.5', 1500000100.5)}
+    stub = stub_private(monkeypatch, {'TradesHistory': history_page('trades', page)})
+    cursor = clear_cursor('trades')
+    try:
+        kraken.sync_trades()
+        trades = dict((t.trade_id, t) for t in stored_trades(old, new))
+        assert set(trades) == set(['kraken|%s' % old, 'kraken|%s' % new])
+        assert trades['kraken|%s' % new].side == 'ask'
+        assert kraken.get_cursor('trades') == {'time': 1500000100.5, 'id': new}
+        # the next sync starts from the cursor, and a page it has seen adds nothing
+        kraken.sync_trades()
+        assert stub.calls[-1] == ('TradesHistory', {'start': new, 'ofs': '0'})
+        assert len(stored_trades(old, new)) == 2
+        # a failed fetch leaves the cursor where it was
+        stub.responses['TradesHistory'] = {'error': ['EService:Unavailable']}
+        kraken.sync_trades()
+        assert kraken.get_cursor('trades') == {'time': 1500000100.5, 'id': new}
+    finally:
+        restore_cursor(*cursor)
+        delete_rows(em.Trade, em.Trade.trade_id, 'kraken|%s' % old, 'kraken|%s' % new)
+
+
+def test_sync_trades_partial_failure(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    first = 'TF%s' % suffix
+    stub = stub_private(monkeypatch, {'TradesHistory': lambda params: history_page(
+        'trades', {first: raw_trade('bid', '400', '1', 1500000200)}, count=2) if params['ofs'] == '0' else None})
+    cursor = clear_cursor('trades')
+    try:
+        kraken.sync_trades()
+        assert stub.methods() == ['TradesHistory', 'TradesHistory']
+        # the second page failed, so the cursor must not move past the rows it held
+        assert kraken.get_cursor('trades') is None
+    finally:
+        restore_cursor(*cursor)
+        delete_rows(em.Trade, em.Trade.trade_id, 'kraken|%s' % first)
+
+
+def test_sync_trades_rollback(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    first, second = 'TR%s' % suffix, 'TS%s' % suffix
+    stub_private(monkeypatch, {'TradesHistory': lambda params: history_page(
+        'trades', {(first if params['ofs'] == '0' else second): raw_trade('bid', '400', '1', 1500000300)}, count=2)})
+    ingest = kraken.ingest_trades
+
+    def fail_second(records):
+        if records[0].id == second:
+            raise RuntimeError("database connection lost")
+        return ingest(records)
+    monkeypatch.setattr(kraken, 'ingest_trades', fail_second)
+    cursor = clear_cursor('trades')
+    try:
+        kraken.sync_trades()
+        # the first page was rolled back with the second, so it must not be remembered as stored
+        assert stored_trades(first) == []
+        assert kraken.known_trade_ids([first]) == set()
+        assert kraken.get_cursor('trades') is None
+    finally:
+        restore_cursor(*cursor)
+        delete_rows(em.Trade, em.Trade.trade_id, 'kraken|%s' % first)
+
+
+def test_sync_ledgers(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    deposit, withdrawal, trade = 'LD%s' % suffix, 'LW%s' % suffix, 'LT%s' % suffix
+    stub = stub_private(monkeypatch, {'Ledgers': history_page('ledger', {
+        deposit: raw_ledger('deposit', 'XXBT', '1.5', 1500000000),
+        withdrawal: raw_ledger('withdrawal', 'ZUSD', '-20', 1500000050),
+        trade: raw_ledger('trade', 'XXBT', '0.1', 1500000099)})})
+    monkeypatch.setattr(kraken, '_ledgers_synced', None)
+    cursor = clear_cursor('ledgers')
+    try:
+        kraken.sync_credits()
+        kraken.get_writes().flush()
+        credits = kraken.session.query(wm.Credit).filter(wm.Credit.ref_id.like('kraken|L%%%s' % suffix)).all()
+        debits = kraken.session.query(wm.Debit).filter(wm.Debit.ref_id.like('kraken|L%%%s' % suffix)).all()
+        # deposits become credits and withdrawals debits; other entries only move the cursor
+        assert [c.ref_id for c in credits] == ['kraken|%s' % deposit] and credits[0].currency == 'BTC'
+        assert [d.ref_id for d in debits] == ['kraken|%s' % withdrawal] and debits[0].currency == 'USD'
+        assert kraken.get_cursor('ledgers') == {'time': 1500000099, 'id': trade}
+        # sync_debits straight after is answered by the same pass
+        kraken.sync_debits()
+        assert stub.methods() == ['Ledgers']
+        # once the reuse window has passed it fetches again, from the cursor
+        synced = kraken._ledgers_synced
+        kraken._ledgers_synced = (synced[0] - LEDGER_SYNC_REUSE - 1,) + synced[1:]
+        kraken.sync_debits()
+        assert stub.calls[-1] == ('Ledgers', {'type': 'all', 'start': trade, 'ofs': '0'})
+        # a rescan is not answered by a pass which was not one
+        kraken.sync_credits(rescan=True)
+        assert stub.methods() == ['Ledgers'] * 3
+    finally:
+        restore_cursor(*cursor)
+        delete_rows(wm.Credit, wm.Credit.ref_id, 'kraken|%s' % deposit)
+        delete_rows(wm.Debit, wm.Debit.ref_id, 'kraken|%s' % withdrawal)
+
+
+def test_backfill_windows(monkeypatch):
+    suffix = binascii.hexlify(os.urandom(4))
+    early, late = 'BE%s' % suffix, 'BL%s' % suffix
+    pages = {'1000': history_page('trades', {early: raw_trade('bid', '400', '1', 1050)}), '1100': None}
+    stub = stub_private(monkeypatch, {'TradesHistory': lambda params: pages[params['start']]})
+    cursor = clear_cursor('trades')
+    done_key = BACKFILL_KEY % (kraken.manager_user.id, 'trades')
+    saved = kraken.red.smembers(done_key)
+    kraken.red.delete(done_key)
+    try:
+        # the second window fails, so it is left for the next run and the cursor is not set
+        assert kraken.backfill('trades', begin=1000, end=1200, window=100) == [(1100, 1200)]
+        assert kraken.red.smembers(done_key) == set(['1000:1100'])
+        assert kraken.get_cursor('trades') is None
+        assert len(stored_trades(early)) == 1
+        # the next run resumes with the failed window only
+        pages['1100'] = history_page('trades', {late: raw_trade('ask', '401', '1', 1150)})
+        del stub.calls[:]
+        assert kraken.backfill('trades', begin=1000, end=1200, window=100) == []
+        assert [params['start'] for method, params in stub.calls] == ['1100']
+        assert kraken.red.smembers(done_key) == set(['1000:1100', '1100:1200'])
+        assert kraken.get_cursor('trades') == {'time': 1150, 'id': late}
+        assert len(stored_trades(late)) == 1
+    finally:
+        kraken.red.delete(done_key)
+        if saved:
+            kraken.red.sadd(done_key, *saved)
+        restore_cursor(*cursor)
+        delete_rows(em.Trade, em.Trade.trade_id, 'kraken|%s' % early, 'kraken|%s' % late)
+
+
 class TestPluginRunning(unittest.TestCase):
     def setUp(self):
         start_test_man('kraken')